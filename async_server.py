@@ -0,0 +1,323 @@
+"""Async server for Melon Tasting Reservations
+
+The same site as server.py, served over ASGI. Search, my reservations,
+booking and login are asyncio handlers here: they reach the database through
+SQLAlchemy's async engine (asyncpg on Postgres) and await bcrypt in the
+password pool, so a slow client or a slow query holds a coroutine instead of
+a thread. They render the same templates and share the session cookie,
+identity cache, availability index, rate limits and idempotency keys.
+/slot_events streams from here too, without holding a thread per open page.
+Every other route is handed to the Flask app in server.py, each request on
+its own thread from a pool of WSGI_THREADS.
+
+    $ hypercorn async_server:application --bind 0.0.0.0:5002
+
+Compare it with the threaded server under the same load:
+
+    $ python3 benchmark.py --skip-seed --url http://localhost:5002
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from jinja2 import StrictUndefined
+from quart import Quart, Response, flash, redirect, render_template, request, session
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import events
+import idempotency
+import model
+import server
+import versions
+from availability import availability_index
+from current_user import UserIdentity, identity_cache
+from passwords import password_hasher, PasswordServiceBusy
+from rate_limit import client_address, rate_limiter
+
+DATABASE_URI = os.environ.get('DATABASE_URI', 'postgresql:///reservations')
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+ASYNC_PATHS = {'/login', '/my_reservations', '/select_appointment', '/record_appointment', '/slot_events'}
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 20))  # Flask requests in flight at once
+
+app = Quart(__name__)
+app.secret_key = server.app.secret_key  # Same cookies as the Flask app, so sessions carry over.
+app.jinja_env.undefined = StrictUndefined
+
+async_session = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+wsgi_threads = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+
+class ThreadPoolWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """asgiref's WsgiToAsgiInstance, but on a thread from wsgi_threads.
+
+    asgiref runs every WSGI call on one shared thread, so one slow or
+    streaming response would hold up every other Flask route."""
+
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False, executor=wsgi_threads)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi with ThreadPoolWsgiToAsgiInstance."""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiToAsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+flask_application = ThreadPoolWsgiToAsgi(server.app)
+
+
+async def application(scope, receive, send):
+    """The ASGI entry point: ASYNC_PATHS here, everything else from the Flask app."""
+
+    if scope['type'] == 'http' and scope['path'] not in ASYNC_PATHS:
+        await flask_application(scope, receive, send)
+    else:
+        await app(scope, receive, send)
+
+
+def async_uri(db_uri):
+    """'postgresql:///reservations' -> 'postgresql+asyncpg:///reservations'."""
+
+    scheme, separator, rest = db_uri.partition('://')
+    return ASYNC_DRIVERS.get(scheme, scheme) + separator + rest
+
+
+def connect_to_async_db(db_uri=DATABASE_URI):
+    """Point async_session at db_uri, with the same pool settings as model.connect_to_db()."""
+
+    engine_options = {'pool_pre_ping': model.DB_POOL_PRE_PING, 'pool_recycle': model.DB_POOL_RECYCLE}
+    if not db_uri.startswith('sqlite'):
+        engine_options.update(pool_size=model.DB_POOL_SIZE, max_overflow=model.DB_MAX_OVERFLOW)
+    async_session.configure(bind=create_async_engine(async_uri(db_uri), **engine_options))
+
+
+@app.before_serving
+async def connect():
+    """Both apps talk to the same database."""
+
+    model.connect_to_db(server.app, db_uri=DATABASE_URI)
+    connect_to_async_db(DATABASE_URI)
+
+
+async def get_current_user(db_session):
+    """current_user.get_current_user() for Quart: the identity cache, then one query."""
+
+    user_id = session.get("user_id")
+    if user_id is None:
+        return None
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        user = await db_session.get(model.User, user_id)
+        if user is None:
+            return None
+        identity = UserIdentity(user_id=user.user_id, login_name=user.login_name)
+        identity_cache.set(user_id, identity)
+    return identity
+
+
+def remote_address():
+    """The client's address, read through TRUSTED_PROXIES like server.py's ProxyFix does."""
+
+    return client_address(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+
+async def load_availability(db_session):
+    """Fill the availability index if it's empty or stale, like its own load() does for Flask."""
+
+    if availability_index.is_stale():
+        availability_index.fill((await db_session.execute(availability_index.load_statement())).all())
+
+
+@app.route('/login', methods=['POST'])
+async def login_process():
+    """Process login."""
+
+    form = await request.form
+    login_name = form["login_name"]
+    password = form["password"]
+
+    # Before any database or bcrypt work:
+    if not (rate_limiter.allow('login_address', remote_address())
+            and rate_limiter.allow('login_name', login_name)):
+        await flash("Too many login attempts. Please wait a minute and try again.")
+        return redirect("/")
+
+    async with async_session() as db_session:
+        user = (await db_session.execute(crud.user_by_login_name_statement(login_name))).scalars().first()
+        try:
+            password_matched = user is not None and await password_hasher.verify_async(
+                password, user.hashed_password)
+        except PasswordServiceBusy:
+            await flash("We're swamped with logins right now. Please try again in a moment.")
+            return redirect("/")
+        if password_matched and password_hasher.needs_rehash(user.hashed_password):
+            try:
+                await db_session.execute(crud.set_password_statement(
+                    user.user_id, await password_hasher.hash_async(password)))
+                await db_session.commit()
+            except PasswordServiceBusy:
+                pass  # Like crud.does_password_match(): the upgrade waits for the next login.
+
+    if password_matched:
+        session["user_id"] = user.user_id
+        identity_cache.set(user.user_id, UserIdentity(user_id=user.user_id, login_name=user.login_name))
+        return redirect("/my_reservations")
+    await flash("Oops, Login Name and Password didn't match.")
+    return redirect("/")
+
+
+@app.route("/my_reservations")
+async def my_reservations():
+    """Display a page of the user's reservations, like server.my_reservations()."""
+
+    upcoming = request.args.get("when") != "past"
+    cursor = request.args.get("after")
+    etag = versions.page_etag(session, 'my_reservations', upcoming, cursor)
+    if versions.is_fresh(session, request.if_none_match, etag):
+        return with_etag(etag, Response("", status=304))
+
+    after = crud.parse_reservations_cursor(cursor) if cursor else None
+    page_size = crud.MY_RESERVATIONS_PAGE_SIZE
+    now = datetime.now()
+
+    async with async_session() as db_session:
+        user = await get_current_user(db_session)
+        if user is None:
+            return redirect("/")
+        rows = (await db_session.execute(crud.my_reservations_page_statement(
+            user.user_id, upcoming, now, after, page_size + 1))).all()
+        if not upcoming and len(rows) <= page_size:
+            rows += (await db_session.execute(crud.archived_reservations_statement(
+                user.user_id, now, after, page_size + 1 - len(rows)))).all()
+
+    my_reservations, next_cursor = crud.format_reservations_page(rows, page_size)
+    return with_etag(etag, Response(await render_template(
+        'my_reservations.html', user=user, my_reservations=my_reservations,
+        upcoming=upcoming, next_cursor=next_cursor, idempotency_key=idempotency.new_key(),
+        user_logged_in=True)))
+
+
+@app.route("/select_appointment", methods=["GET"])
+async def select_appointment():
+    """Users search for free appointments."""
+
+    date = request.args["pick-date"]
+    time1 = request.args["pick-time1"]
+    time2 = request.args["pick-time2"]
+    etag = versions.page_etag(session, 'select_appointment', date, time1, time2,
+                              availability=availability_index.full_slots_on(date))
+    if versions.is_fresh(session, request.if_none_match, etag):
+        return with_etag(etag, Response("", status=304))
+
+    reservation_date = datetime.strptime(date, '%Y-%m-%d').date()
+
+    async with async_session() as db_session:
+        user = await get_current_user(db_session)
+        if user is None:
+            return redirect("/")
+        day_taken = (await db_session.execute(crud.reservation_this_day_statement(
+            user.user_id, reservation_date))).scalar()
+        await load_availability(db_session)
+
+    avaliable_times = False if day_taken else crud.list_free_appointments(
+        date, start_time=min(time1, time2), end_time=max(time1, time2))
+
+    return with_etag(etag, Response(await render_template('select_appointment.html',
+                                                          avaliable_times=avaliable_times,
+                                                          day_taken=day_taken,
+                                                          desired_day=date,
+                                                          start_time=min(time1, time2),
+                                                          end_time=max(time1, time2),
+                                                          idempotency_key=idempotency.new_key(),
+                                                          user_logged_in=True)))
+
+
+@app.route('/record_appointment', methods=['POST'])
+async def record_appointment():
+    """Book a reservation"""
+
+    form = await request.form
+    idempotency_key = idempotency.make_key(
+        session.get("user_id"), request.path, request.headers, await request.values)
+    pending, replayed = await idempotency.claim_async(idempotency_key)
+    if replayed is idempotency.IN_PROGRESS:
+        await flash("We're still working on that. Check your reservations again in a moment.")
+        return redirect("/my_reservations")
+    if replayed:
+        return await respond(None, *replayed)
+
+    claim = (idempotency_key, pending) if pending else None
+    try:
+        if not rate_limiter.allow(
+                'booking', f'user:{session["user_id"]}', f'address:{remote_address()}'):
+            await flash("You're booking faster than we can pour. Please wait a minute and try again.")
+            return redirect("/my_reservations")
+
+        desired_slot = crud.parse_slot_key(form['book_this_appointment'])
+        if desired_slot is None:
+            return await respond(claim, "Sorry, we couldn't find that appointment.", "/specify_time_window")
+        human_reservation_datetime = crud.format_human_datetime(desired_slot)
+
+        async with async_session() as db_session:
+            user = await get_current_user(db_session)
+            booked = user is not None and await book(db_session, user.user_id, desired_slot)
+
+        if booked:
+            return await respond(
+                claim, f"You got it! See you on {human_reservation_datetime}", "/my_reservations")
+        return await respond(
+            claim, f"Sorry, We could not get you {human_reservation_datetime}", "/my_reservations")
+    finally:
+        if claim:
+            # Only still there if no outcome replaced it: turned away, or failed.
+            idempotency.idempotent_outcomes.discard(*claim)
+
+
+async def book(db_session, user_id, appointment_date_time):
+    """crud.get_or_create_appointment() then crud.can_user_book_this_reservation(), awaited.
+
+    The same crud.book_slot() the Flask app's booking runs, on db_session's
+    connection. Returns the reservation_id, or False."""
+
+    reservation_id, now_full = await db_session.run_sync(crud.book_slot, user_id, appointment_date_time)
+    if now_full:
+        crud.slot_taken(appointment_date_time)
+    if now_full is not None:
+        versions.reservations_changed(user_id, session)
+    return reservation_id
+
+
+def with_etag(etag, response):
+    """server.with_etag() for Quart responses."""
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route("/slot_events")
+async def slot_events():
+    """server.slot_events(), awaiting the broker instead of blocking a thread."""
+
+    return Response(
+        events.stream_slot_events_async(day=request.args.get("day")),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def respond(claim, message, location):
+    """server.respond() for Quart: flash, redirect, and remember the outcome for retries.
+
+    claim is the (key, Pending) from idempotency.claim_async(), or None."""
+
+    if claim:
+        idempotency.idempotent_outcomes.replace(*claim, (message, location))
+    if message:
+        await flash(message)
+    return redirect(location)
@@ -0,0 +1,123 @@
+"""In-process availability index for Melon Tasting Reservations"""
+
+import os
+import time as clock
+from datetime import datetime, time
+from sqlalchemy import select
+
+import schedule_rules
+from model import db, primary_bind, Appointment
+
+AVAILABILITY_MAX_AGE = float(os.environ.get('AVAILABILITY_MAX_AGE', 30))  # seconds between reloads
+
+
+class AvailabilityIndex:
+    """Starts of fully booked slots (every station taken), kept as a set per calendar day.
+
+    Free slots are the schedule rule's slots minus these, so a time-window
+    search never touches the database and costs the same however many
+    reservations there are. Loaded from the primary (upcoming full slots only),
+    kept current by crud.slot_taken and crud.slot_freed, and reloaded once it's
+    max_age seconds old.
+
+    Each process keeps its own copy, so bookings and cancellations made by
+    another worker show up here within max_age seconds. The booking path is
+    guarded by the database, so a stale slot can be displayed but never
+    double-booked.
+    """
+
+    def __init__(self, max_age=AVAILABILITY_MAX_AGE):
+        self.max_age = max_age
+        self.full_slots_by_day = {}  # date -> {appointment_date_time, ...}
+        self.loaded = False
+        self.loaded_at = None  # time.monotonic() of the last fill()
+
+    def is_stale(self):
+        """True if the index needs a load(): never loaded, reset(), or older than max_age."""
+
+        return not self.loaded or clock.monotonic() - self.loaded_at >= self.max_age
+
+    def load(self):
+        """One query, on ix_appointments_full_slots, for every upcoming slot with no station left.
+
+        Reads the primary: a lagging replica would add its lag to every reload.
+        Only this query does; the request's other reads still go to the replicas."""
+
+        self.fill(db.session.execute(self.load_statement(), bind=primary_bind()).all())
+
+    @staticmethod
+    def load_statement():
+        """SELECT the start of every upcoming full slot."""
+
+        today = datetime.combine(datetime.now().date(), time(0))
+        return select(Appointment.appointment_date_time).where(
+            Appointment.appointment_date_time >= today).where(
+                Appointment.booked_count >= Appointment.capacity)
+
+    def fill(self, full_slots):
+        """Replace the index with full_slots, rows from load_statement()."""
+
+        self.full_slots_by_day = {}
+        for (appointment_date_time,) in full_slots:
+            self.full_slots_by_day.setdefault(
+                appointment_date_time.date(), set()).add(appointment_date_time)
+        self.loaded = True
+        self.loaded_at = clock.monotonic()
+
+    def reset(self):
+        """Forget everything; the next search reloads from the database."""
+
+        self.full_slots_by_day = {}
+        self.loaded = False
+
+    def free_slots(self, desired_day, start_time, end_time):
+        """Return the bookable slot starts on desired_day between start_time
+        and end_time, inclusive, in order.
+
+        desired_day is '%Y-%m-%d'; start_time and end_time are 'HH:MM' or 'HH:MM:SS'.
+        """
+
+        if self.is_stale():
+            self.load()
+
+        day = datetime.strptime(desired_day, '%Y-%m-%d').date()
+        search_start = datetime.combine(day, time.fromisoformat(start_time))
+        search_end = datetime.combine(day, time.fromisoformat(end_time))
+
+        rule = schedule_rules.schedule_rule
+        now = datetime.now()
+        if day > rule.last_day(now):
+            return []
+        full_slots = self.full_slots_by_day.get(day, set())
+        return [
+            slot for slot in rule.slots_between(max(search_start, now), search_end)
+            if slot not in full_slots]
+
+    def full_slots_on(self, desired_day):
+        """desired_day's full slots, sorted, for an ETag; None while the index is stale.
+
+        Needs no query: a stale index would have to load() to answer."""
+
+        if self.is_stale():
+            return None
+        day = datetime.strptime(desired_day, '%Y-%m-%d').date()
+        return tuple(sorted(self.full_slots_by_day.get(day, ())))
+
+    def mark_taken(self, appointment_date_time):
+        """Call after a reservation that takes this slot's last station is committed."""
+
+        if not self.loaded:
+            return  # Nothing cached yet; load() will see the new reservation.
+        self.full_slots_by_day.setdefault(
+            appointment_date_time.date(), set()).add(appointment_date_time)
+
+    def mark_free(self, appointment_date_time):
+        """Call after a reservation on this full slot is deleted."""
+
+        if not self.loaded:
+            return
+        self.full_slots_by_day.get(appointment_date_time.date(), set()).discard(
+            appointment_date_time)
+
+
+availability_index = AvailabilityIndex()
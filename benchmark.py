@@ -0,0 +1,272 @@
+"""Load test for Melon Tasting Reservations
+
+Seeds a synthetic dataset (users x days x reservations per user), then has
+concurrent clients log in and hammer the main routes. Reports throughput and
+p50/p95/p99 latency per route and saves the numbers as JSON in
+BENCHMARK_RESULTS_DIR so runs can be compared over time.
+
+    $ python3 benchmark.py --users 1000 --days 30 --reservations-per-user 10 --clients 8
+
+By default requests go through Flask's test client, in this process. Pass
+--url http://localhost:5001 to drive a running server instead (it must be
+connected to the same database). This DELETES everything in --db-uri.
+To compare the threaded and async servers, run once against each with the
+same dataset and a --label apiece:
+
+    $ python3 benchmark.py --url http://localhost:5001 --label sync
+    $ python3 benchmark.py --url http://localhost:5002 --label async --skip-seed
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from random import Random
+
+import crud
+import migrations
+import model
+import schedule_rules
+import seed_database
+from passwords import password_hasher
+from rate_limit import rate_limiter
+from server import app
+
+BENCHMARK_DB_URI = "postgresql:///benchmark_reservations"
+BENCHMARK_RESULTS_DIR = "benchmark_results"
+BENCHMARK_PASSWORD = "melon"
+ROUTES = ["/login", "/my_reservations", "/select_appointment", "/record_appointment",
+          "/cancel_reservation"]
+
+
+class TestClientDriver:
+    """Sends requests through Flask's test client; one per virtual user."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class HttpDriver:
+    """Sends real HTTP requests to a running server; keeps its own cookies."""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None  # Time the route itself, not the page it redirects to.
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect())
+
+    def get(self, path):
+        return self.send(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data):
+        return self.send(urllib.request.Request(
+            self.base_url + path, data=urllib.parse.urlencode(data).encode('utf8')))
+
+    def send(self, http_request):
+        try:
+            with self.opener.open(http_request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+def seed_benchmark_database(users, days, reservations_per_user, bcrypt_rounds):
+    """Replace everything in the connected database with a synthetic dataset."""
+
+    model.db.drop_all()
+    model.db.create_all()
+    migrations.stamp()
+
+    schedule_rules.schedule_rule.horizon_days = days
+    seed_database.SEED_USERS = users
+    seed_database.SEED_RESERVATIONS = reservations_per_user
+    seed_database.POSSIBLE_PASSWORDS = [BENCHMARK_PASSWORD]
+    seed_database.SEED_BCRYPT_ROUNDS = bcrypt_rounds
+    seed_database.seed_users_and_reservations()
+
+
+def virtual_user(driver, login_name, requests_per_route, days, seed, timings):
+    """Log in, then search, book, look at and cancel reservations, timing every request."""
+
+    rng = Random(seed)
+
+    def timed(route, send):
+        start = time.perf_counter()
+        status = send()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        timings[route].append((elapsed_ms, status >= 400))
+
+    timed("/login", lambda: driver.post(
+        "/login", {"login_name": login_name, "password": BENCHMARK_PASSWORD}))
+
+    for _ in range(requests_per_route):
+        day = date.today() + timedelta(days=rng.randint(1, days))
+        hour = rng.randint(0, 22)
+        window = f"pick-date={day}&pick-time1={hour:02d}:00&pick-time2={hour + 1:02d}:59"
+        timed("/select_appointment", lambda: driver.get(f"/select_appointment?{window}"))
+
+        slot = f"{day}T{hour:02d}:{rng.choice(['00', '30'])}"
+        timed("/record_appointment", lambda: driver.post(
+            "/record_appointment", {"book_this_appointment": slot}))
+
+        timed("/my_reservations", lambda: driver.get("/my_reservations"))
+
+        with app.app_context():  # Finding something to cancel isn't part of the timing.
+            user = crud.get_user_by_login_name(login_name)
+            my_reservations = crud.get_my_reservations(user=user, human_readable=False)
+            model.db.session.remove()
+        if my_reservations:
+            reservation_id = rng.choice(my_reservations)[1]
+            timed("/cancel_reservation", lambda: driver.get(f"/cancel_reservation/{reservation_id}"))
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(timings, wall_seconds):
+    """Per-route request count, errors, throughput and latency percentiles."""
+
+    summary = {}
+    for route in ROUTES:
+        latencies = sorted(elapsed_ms for elapsed_ms, _ in timings[route])
+        summary[route] = {
+            'requests': len(latencies),
+            'errors': sum(1 for _, failed in timings[route] if failed),
+            'throughput_rps': len(latencies) / wall_seconds if wall_seconds else None,
+            'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+        }
+    return summary
+
+
+def git_commit():
+    """The commit being measured, if we're in a git checkout."""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    """Seed, run every virtual user, and return the results dictionary."""
+
+    model.connect_to_db(app, db_uri=args.db_uri)
+    app.config['TESTING'] = True
+    password_hasher.rounds = args.bcrypt_rounds  # Otherwise the first login of each user rehashes.
+    # Every virtual user shares one address; measure the routes, not the rate limiter:
+    rate_limiter.limits = {name: (1e9, 1e9) for name in rate_limiter.limits}
+
+    if not args.skip_seed:
+        with app.app_context():
+            seed_benchmark_database(
+                args.users, args.days, args.reservations_per_user, args.bcrypt_rounds)
+    schedule_rules.schedule_rule.horizon_days = args.days
+
+    timings = {route: [] for route in ROUTES}
+    timings_lock = threading.Lock()
+
+    def run_one(client_number):
+        client_timings = {route: [] for route in ROUTES}
+        driver = HttpDriver(args.url) if args.url else TestClientDriver()
+        login_name = f"Melon Taster {client_number % args.users + 1}"
+        virtual_user(driver, login_name, args.requests, args.days, client_number, client_timings)
+        with timings_lock:
+            for route, route_timings in client_timings.items():
+                timings[route].extend(route_timings)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        list(pool.map(run_one, range(args.clients)))
+    wall_seconds = time.perf_counter() - start
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'target': args.url or 'flask test client',
+        'label': args.label,
+        'dataset': {
+            'users': args.users,
+            'days': args.days,
+            'reservations_per_user': args.reservations_per_user,
+            'bcrypt_rounds': args.bcrypt_rounds,
+        },
+        'clients': args.clients,
+        'requests_per_route_per_client': args.requests,
+        'wall_seconds': wall_seconds,
+        'routes': summarize(timings, wall_seconds),
+    }
+
+
+def save_results(results, results_dir=BENCHMARK_RESULTS_DIR):
+    """Write results to results_dir/<timestamp>.json; returns the path."""
+
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, results['timestamp'].replace(':', '') + '.json')
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    return path
+
+
+def print_results(results):
+    """One line per route."""
+
+    print(f"{'route':<22}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, stats in results['routes'].items():
+        if not stats['requests']:
+            continue
+        print(f"{route:<22}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+
+
+def parse_args(argv=None):
+    """Command line options; see the module docstring."""
+
+    parser = argparse.ArgumentParser(description="Load test the Melon Tasting Reservations routes.")
+    parser.add_argument('--db-uri', default=BENCHMARK_DB_URI)
+    parser.add_argument('--url', help="base URL of a running server; default is the Flask test client")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--reservations-per-user', type=int, default=10,
+                        help="booking attempts per seeded user; sets reservation density")
+    parser.add_argument('--bcrypt-rounds', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8, help="concurrent virtual users")
+    parser.add_argument('--requests', type=int, default=25, help="requests per route per client")
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the data already in --db-uri")
+    parser.add_argument('--results-dir', default=BENCHMARK_RESULTS_DIR)
+    parser.add_argument('--label', default='', help="saved with the results, e.g. sync or async")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run_benchmark(args)
+    print_results(results)
+    print(f"Saved to {save_results(results, args.results_dir)}")
@@ -0,0 +1,94 @@
+"""Small in-process caches for Melon Tasting Reservations"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A bounded dictionary: entries expire after ttl seconds, and the least
+    recently used entry is dropped once there are more than maxsize.
+
+    Safe to share between request threads. Each process has its own."""
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """The cached value, or default if it's missing or expired."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache value under key for the next ttl seconds."""
+
+        with self.lock:
+            self.store(key, value)
+
+    def add(self, key, value):
+        """Cache value under key unless key already holds a live entry. Returns True if it went in."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                return False
+            self.store(key, value)
+            return True
+
+    def replace(self, key, old, value):
+        """Cache value under key only if key still holds old (the same object). Returns True if it did."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] is not old:
+                return False
+            self.store(key, value)
+            return True
+
+    def discard(self, key, old):
+        """Forget key only if it still holds old (the same object)."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is old:
+                del self.entries[key]
+
+    def store(self, key, value):
+        """set() for callers already holding the lock."""
+
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Forget key; returns whatever was cached, expired or not."""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        """Forget everything."""
+
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, default=self) is not self
+
+    def __len__(self):
+        return len(self.entries)
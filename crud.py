@@ -1,9 +1,19 @@
 """CRUD operations for Melon Tasting Reservations"""
 
-import bcrypt
-from datetime import datetime
-from model import db, connect_to_db, User, Appointment, Reservation
-from sqlalchemy import func
+from datetime import datetime, time, timedelta
+from model import (db, connect_to_db, use_primary, User, Appointment, Reservation, ArchivedReservation,
+                   WaitlistEntry)
+from availability import availability_index
+from events import publish_slot_event
+from passwords import password_hasher, PasswordServiceBusy
+import schedule_rules
+import versions
+from sqlalchemy import delete, exists, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+SLOT_KEY_FORMAT = '%Y-%m-%dT%H:%M'  # How a slot travels through forms and URLs.
+MY_RESERVATIONS_PAGE_SIZE = 20
+MAX_BATCH_BOOKINGS = 31  # slots per book_reservations() call
 
 """ -=-=-=-=-=-=-=-=-=-=-=-=-=-=- USER FUNCTIONS -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- """
 
@@ -34,7 +44,13 @@ def get_user_by_id(user_id: int) -> User:
 def get_user_by_login_name(login_name: str) -> User:
     """Return a user by login_name."""
 
-    return User.query.filter(User.login_name == login_name).first()
+    return db.session.execute(user_by_login_name_statement(login_name)).scalars().first()
+
+
+def user_by_login_name_statement(login_name):
+    """SELECT the User with login_name."""
+
+    return select(User).where(User.login_name == login_name)
 
 
 def check_then_create_user(login_name: str, password: str):  # -> Optional[bool, ]
@@ -58,25 +74,36 @@ def does_this_user_exist_already(login_name: str) -> bool:
 
 
 def does_password_match(user: User, password_from_form: str) -> bool:
-    """Check hashed password. Returns boolean."""
+    """Check hashed password. Returns boolean.
 
-    if bcrypt.checkpw(
-            password_from_form.encode('utf8'),
-            user.hashed_password.encode('utf8')):
+    A hash made with an old bcrypt cost is replaced on a successful login,
+    unless the password pool is too busy; then it waits for the next login."""
+
+    if password_hasher.verify(password_from_form, user.hashed_password):
         print("Password matched!")
+        if password_hasher.needs_rehash(user.hashed_password):
+            try:
+                user.hashed_password = hash_it(password_from_form)
+                db.session.commit()
+            except PasswordServiceBusy:
+                pass  # The password matched; don't turn them away over an upgrade.
         return True
     else:
         print("Password did not match.")
         return False
 
 
+def set_password_statement(user_id, hashed_password):
+    """UPDATE a user's hashed_password."""
+
+    return update(User).where(User.user_id == user_id).values(
+        hashed_password=hashed_password).execution_options(synchronize_session=False)
+
+
 def hash_it(password: str) -> str:
-    """Hash and Salt plaintext password using bcrypt."""
+    """Hash and Salt plaintext password using bcrypt, off the request thread."""
 
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf8'), salt)
-    hashed_password = hashed.decode('utf8')
-    return hashed_password
+    return password_hasher.hash(password)
 
 
 """ -=-=-=-=-=-=-=-=-=-=-=-=-=-=- APPOINTMENT FUNCTIONS -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- """
@@ -85,12 +112,13 @@ def hash_it(password: str) -> str:
 def create_appointment(appointment_date_time):
     """Create and return a new appointment."""
 
-    appointment = Appointment(appointment_date_time=appointment_date_time)
+    appointment = Appointment(appointment_date_time=appointment_date_time,
+                              capacity=schedule_rules.schedule_rule.stations)
     return appointment
 
 
 def get_appointments():
-    """Return all appointments."""
+    """Return all appointments. Only slots that have been booked have a row."""
 
     return Appointment.query.all()
 
@@ -101,6 +129,38 @@ def get_appointment_by_id(appointment_id):
     return Appointment.query.get(appointment_id)
 
 
+def get_appointment_by_date_time(appointment_date_time):
+    """Return the appointment row for a slot, if it has one."""
+
+    return Appointment.query.filter(
+        Appointment.appointment_date_time == appointment_date_time).first()
+
+
+def get_or_create_appointment(appointment_date_time):
+    """Return the appointment row for a bookable slot, writing it the first time.
+
+    Returns None if appointment_date_time isn't a bookable slot."""
+
+    if not schedule_rules.schedule_rule.is_bookable(appointment_date_time):
+        return None
+
+    appointment = get_appointment_by_date_time(appointment_date_time)
+    if appointment is None:
+        # Two people can open the same slot at once; the unique index keeps one row.
+        db.session.execute(new_appointment_statement(appointment_date_time, db.engine.dialect.name))
+        db.session.commit()
+        appointment = get_appointment_by_date_time(appointment_date_time)
+    return appointment
+
+
+def new_appointment_statement(appointment_date_time, dialect_name):
+    """INSERT the slot's appointment row, or do nothing if it's there already."""
+
+    return insert_or_do_nothing(Appointment, dialect_name).values(
+        appointment_date_time=appointment_date_time,
+        capacity=schedule_rules.schedule_rule.stations)
+
+
 def search_for_available_appointments(user, desired_day, start_time=None, end_time=None):
     """Return all available appointments. desired_day must be in time_format = '%Y-%m-%d'
 
@@ -110,58 +170,98 @@ def search_for_available_appointments(user, desired_day, start_time=None, end_ti
     if does_user_already_have_a_reservation_this_day(user, desired_day):
         return False  # Day not eligible for consideration.
 
+    return list_free_appointments(desired_day, start_time, end_time)
+
+
+def list_free_appointments(desired_day, start_time=None, end_time=None):
+    """The free slots part of search_for_available_appointments(), without the day check.
+
+    Schedule rule minus the in-process index of full slots; no database work
+    once the index is loaded."""
+
     if not start_time:
         start_time = "00:00:00"
     if not end_time:
         end_time = "23:59:59"
-    search_start = f"{desired_day} {start_time}"
-    search_end = f"{desired_day} {end_time}"
 
-    appointments_list = db.session.query(Appointment).filter(
-        Appointment.appointment_id.not_in(db.session.query(Reservation.appointment_id))).filter(
-        Appointment.appointment_date_time <= search_end).filter(
-        Appointment.appointment_date_time >= search_start).order_by(
-        Appointment.appointment_date_time).all()
+    free_slots = availability_index.free_slots(desired_day, start_time, end_time)
 
-    if appointments_list:
-        results_dict = format_appointments_list(appointments_list)
+    if free_slots:
+        results_dict = format_appointments_list(free_slots)
         return results_dict
-        # These are Appointment objects.
-        # Use strftime to display them pretty in the UI if that is the destination.
     else:
         return False  # None found on that day or within those times.
 
 
-def format_appointments_list(appointments_list):
-    """Make a dictionary of appointment_ids and human formatted datetimes."""
+def format_appointments_list(free_slots):
+    """Make a dictionary of slot keys and human formatted datetimes.
+
+    free_slots is a list of appointment_date_times."""
 
     results_dict = {}
-    for jj in appointments_list:
-        results_dict[jj.appointment_id] = format_human_datetime(
-            jj.appointment_date_time)
+    for appointment_date_time in free_slots:
+        results_dict[format_slot_key(appointment_date_time)] = format_human_datetime(
+            appointment_date_time)
     return results_dict
 
 
+def get_availability_calendar(user, first_day, last_day, start_time=None, end_time=None,
+                              include_slots=False):
+    """Free slot counts for every bookable day from first_day to last_day (date objects).
+
+    Returns {'%Y-%m-%d': {'free': count}, ...}, plus a 'slots' dictionary like
+    search_for_available_appointments() when include_slots is True. Days the user
+    already has a reservation on are left out. One query, whatever the range.
+    """
+
+    if not start_time:
+        start_time = "00:00:00"
+    if not end_time:
+        end_time = "23:59:59"
+
+    first_day = max(first_day, datetime.now().date())
+    last_day = min(last_day, schedule_rules.schedule_rule.last_day())
+    my_reservation_dates = {
+        reservation_date for (reservation_date,) in db.session.query(
+            Reservation.reservation_date).filter(
+                Reservation.user_id == user.user_id).filter(
+                    Reservation.reservation_date.between(first_day, last_day))}
+
+    calendar = {}
+    day = first_day
+    while day <= last_day:
+        if day not in my_reservation_dates:
+            free_slots = availability_index.free_slots(
+                format_computer_date(day), start_time, end_time)
+            calendar[format_computer_date(day)] = {'free': len(free_slots)}
+            if include_slots:
+                calendar[format_computer_date(day)]['slots'] = format_appointments_list(free_slots)
+        day += timedelta(days=1)
+    return calendar
+
+
+def forget_cached_availability():
+    """Call whenever reservations are written without going through crud."""
+
+    availability_index.reset()
+
+
 def min_scheduled_date():
-    """The earliest date in the database as raw datetime object."""
+    """The earliest bookable date as raw datetime object."""
 
-    today = datetime.now()
-    min_appointment = db.session.query(func.min(
-        Appointment.appointment_date_time)).first()[0]
     # Can't schedule things in the past:
-    min_date = max(today, min_appointment)
-    return min_date
+    return datetime.now()
 
 
 def max_scheduled_date():
-    """The furthest date in the database as raw datetime object."""
+    """The furthest bookable date as raw datetime object."""
 
-    return db.session.query(func.max(
-        Appointment.appointment_date_time)).first()[0]
+    last_day = schedule_rules.schedule_rule.last_day()
+    return datetime.combine(last_day, datetime.min.time())
 
 
 def min_max_date_range():
-    """Determines the date range for scheduling."""
+    """Determines the date range for scheduling. Comes from the schedule rule; no database work."""
 
     min_date_raw = min_scheduled_date()
     min_date = format_computer_date(min_date_raw)
@@ -173,16 +273,6 @@ def min_max_date_range():
 """ -=-=-=-=-=-=-=-=-=-=-=-=-=-=- RESERVATION FUNCTIONS -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- """
 
 
-def create_reservation(user, appointment):
-    """Create and return a new reservation."""
-
-    reservation = Reservation(user=user, appointment=appointment)
-    db.session.add(reservation)
-    db.session.commit()
-
-    return reservation
-
-
 def get_reservations():
     """Return all reservations."""
 
@@ -196,11 +286,156 @@ def get_reservation_by_id(reservation_id):
 
 
 def delete_reservation(reservation_id):
-    """Delete the reservation_id row."""
+    """Delete the reservation_id row.
 
+    The freed station goes to the earliest waiter for that slot, if there is
+    one and the slot can still be booked, in the same transaction; otherwise
+    it's open to everyone."""
+
+    use_primary()
     reservation = get_reservation_by_id(reservation_id)
+    appointment_id = reservation.appointment_id
+    user_id = reservation.user_id
+    slot = reservation.appointment.appointment_date_time
     db.session.delete(reservation)
+    give_back_station(appointment_id)
+    promoted_user_id = None
+    if schedule_rules.schedule_rule.is_bookable(slot):  # Nobody gets booked into a started or past slot.
+        promoted_user_id = promote_waiter(appointment_id, slot, cancelled_by=user_id)
+    reopened = promoted_user_id is None and stations_left(appointment_id) == 1
+    db.session.commit()
+    if reopened:
+        slot_freed(slot)
+    versions.reservations_changed(user_id)
+
+
+def join_waitlist(user, desired_day, start_time=None, end_time=None):
+    """Wait for a slot between start_time and end_time on desired_day (computer readable formats).
+
+    Returns None if desired_day is past or beyond the booking horizon, and
+    False if the user already has a reservation that day. Joining again for
+    the same day keeps the first place in line (and the first window)."""
+
+    wait_date = datetime.strptime(desired_day, '%Y-%m-%d').date()
+    if not datetime.now().date() <= wait_date <= schedule_rules.schedule_rule.last_day():
+        return None
+    if does_user_already_have_a_reservation_this_day(user, desired_day):
+        return False
+    db.session.execute(insert_or_do_nothing(WaitlistEntry).values(
+        user_id=user.user_id,
+        wait_date=wait_date,
+        start_time=time.fromisoformat(start_time or "00:00:00"),
+        end_time=time.fromisoformat(end_time or "23:59:59")))
     db.session.commit()
+    return True
+
+
+def promote_waiter(appointment_id, appointment_date_time, cancelled_by=None):
+    """Book a station at the appointment for its earliest eligible waiter, in the current transaction.
+
+    Eligible: waiting on that day, in a window that covers the slot, with no
+    other reservation that day, and not the user who just cancelled it. Their
+    waitlist entry is used up. Returns the promoted user_id, or None."""
+
+    waiter = db.session.execute(next_waiter_statement(
+        appointment_date_time, cancelled_by)).scalars().first()
+    if waiter is None or not take_station(appointment_id):
+        return None
+    result = db.session.execute(new_reservation_statement(
+        waiter.user_id, appointment_id, appointment_date_time, db.engine.dialect.name))
+    if result.rowcount != 1:
+        give_back_station(appointment_id)  # They booked that day meanwhile.
+        return None
+    db.session.delete(waiter)
+    return waiter.user_id
+
+
+def next_waiter_statement(appointment_date_time, cancelled_by=None):
+    """SELECT the first WaitlistEntry in line for a slot, locked, skipping rows another cancellation has."""
+
+    slot_date, slot_time = appointment_date_time.date(), appointment_date_time.time()
+    return select(WaitlistEntry).where(WaitlistEntry.wait_date == slot_date).where(
+        WaitlistEntry.start_time <= slot_time).where(
+            WaitlistEntry.end_time >= slot_time).where(
+                WaitlistEntry.user_id != cancelled_by).where(
+                    ~exists().where(Reservation.user_id == WaitlistEntry.user_id).where(
+                        Reservation.reservation_date == slot_date)).order_by(
+                            WaitlistEntry.created_at, WaitlistEntry.waitlist_id).limit(1).with_for_update(
+                                skip_locked=True)
+
+
+def used_waitlist_statement(user_id, *wait_dates):
+    """DELETE the user's waitlist entries on wait_dates: they have a reservation on those days now."""
+
+    return delete(WaitlistEntry).where(WaitlistEntry.user_id == user_id).where(
+        WaitlistEntry.wait_date.in_(wait_dates)).execution_options(synchronize_session=False)
+
+
+def take_station(appointment_id):
+    """Claim one of the appointment's stations in the current transaction. False if none are left.
+
+    The check and the increment are one conditional UPDATE, so two workers
+    can't both take the last station."""
+
+    claimed = db.session.execute(take_station_statement(appointment_id))
+    return claimed.rowcount == 1
+
+
+def give_back_station(appointment_id):
+    """Release one of the appointment's stations in the current transaction."""
+
+    db.session.execute(give_back_station_statement(appointment_id))
+
+
+def stations_left(appointment_id):
+    """How many more people can book this appointment. One primary key lookup."""
+
+    return db.session.execute(stations_left_statement(appointment_id)).scalar()
+
+
+def take_station_statement(*appointment_ids):
+    """UPDATE that claims a station at each appointment that has one left; rowcount says how many did."""
+
+    return update(Appointment).where(
+        Appointment.appointment_id.in_(appointment_ids)).where(
+            Appointment.booked_count < Appointment.capacity).values(
+                booked_count=Appointment.booked_count + 1).execution_options(
+                    synchronize_session=False)
+
+
+def give_back_station_statement(*appointment_ids):
+    """UPDATE that releases a station at each appointment."""
+
+    return update(Appointment).where(
+        Appointment.appointment_id.in_(appointment_ids)).where(
+            Appointment.booked_count > 0).values(
+                booked_count=Appointment.booked_count - 1).execution_options(
+                    synchronize_session=False)
+
+
+def stations_left_statement(appointment_id):
+    """SELECT capacity - booked_count for one appointment."""
+
+    return select(Appointment.capacity - Appointment.booked_count).where(
+        Appointment.appointment_id == appointment_id)
+
+
+def slot_taken(appointment_date_time):
+    """Call after a reservation takes a slot's last station: update the index, tell open pages."""
+
+    availability_index.mark_taken(appointment_date_time)
+    publish_slot_event('slot-taken', format_slot_key(appointment_date_time),
+                       format_computer_date(appointment_date_time),
+                       format_human_datetime(appointment_date_time))
+
+
+def slot_freed(appointment_date_time):
+    """Call after a cancellation reopens a full slot: update the index, tell open pages."""
+
+    availability_index.mark_free(appointment_date_time)
+    publish_slot_event('slot-freed', format_slot_key(appointment_date_time),
+                       format_computer_date(appointment_date_time),
+                       format_human_datetime(appointment_date_time))
 
 
 def can_user_book_this_reservation(user, desired_appointment):
@@ -208,50 +443,239 @@ def can_user_book_this_reservation(user, desired_appointment):
 
     1. User can have only one appointment per calendar day.
        Will have to delete it to change an appointment on a day.
-    2. Appointment is already taken by another user.
+    2. Every station at the appointment is already taken.
+
+    One transaction: a conditional UPDATE takes a station, then an
+    INSERT ... ON CONFLICT DO NOTHING on the (user_id, reservation_date) unique
+    constraint writes the reservation. Workers racing for the last station
+    can't both win. A waitlist entry the user had for that day is used up in
+    the same transaction. Returns the new reservation_id, or False.
+
+    If the user already holds this very appointment (a retry of a booking that
+    went through, maybe on another worker), returns that reservation_id instead.
     """
 
-    if not does_user_have_a_conflict_with_desired_appointment(
-            user, desired_appointment) and not (
-                does_this_reservation_exist_already(desired_appointment)):
-        return create_reservation(user, desired_appointment)
-    else:
-        # No reservation for you!
-        return False
+    slot = desired_appointment.appointment_date_time
+    reservation_id, now_full = reserve_station(
+        db.session, user.user_id, desired_appointment.appointment_id, slot)
+    if now_full:
+        slot_taken(slot)
+    if now_full is not None:
+        versions.reservations_changed(user.user_id)
+    return reservation_id
+
+
+def book_slot(session, user_id, appointment_date_time):
+    """get_or_create_appointment() then reserve_station(), on any Session.
+
+    async_server runs this through AsyncSession.run_sync(), so both servers book
+    with the same code. Returns reserve_station()'s (reservation_id or False, now_full)."""
+
+    if not schedule_rules.schedule_rule.is_bookable(appointment_date_time):
+        return False, None
+    appointment_id = get_or_create_appointment_ids([appointment_date_time], session)[appointment_date_time]
+    session.commit()  # The slot's row stays, booked or not, like get_or_create_appointment().
+    return reserve_station(session, user_id, appointment_id, appointment_date_time)
+
+
+def reserve_station(session, user_id, appointment_id, appointment_date_time):
+    """The transaction behind can_user_book_this_reservation(), on any Session. Commits.
+
+    Returns (reservation_id, now_full) for a new reservation, where now_full says
+    it took the last station; (reservation_id, None) for one the user already
+    held at this appointment; (False, None) if there's nothing for them."""
+
+    if session.execute(take_station_statement(appointment_id)).rowcount != 1:
+        return already_booked(session, user_id, appointment_id), None  # No reservation for you!
+
+    result = session.execute(new_reservation_statement(
+        user_id, appointment_id, appointment_date_time, dialect_name(session)))
+    if result.rowcount != 1:
+        # Already booked that day; hand the station back in the same transaction.
+        session.execute(give_back_station_statement(appointment_id))
+        session.commit()
+        return already_booked(session, user_id, appointment_id), None
+
+    reservation_id = result.inserted_primary_key[0]
+    session.execute(used_waitlist_statement(user_id, appointment_date_time.date()))
+    now_full = session.execute(stations_left_statement(appointment_id)).scalar() == 0
+    session.commit()
+    return reservation_id, now_full
+
+
+def already_booked(session, user_id, appointment_id):
+    """The user's reservation_id at this appointment, or False."""
+
+    return session.execute(already_booked_statement(user_id, appointment_id)).scalar() or False
+
+
+def already_booked_statement(user_id, appointment_id):
+    """SELECT the reservation_id the user holds at the appointment, if any."""
+
+    return select(Reservation.reservation_id).where(Reservation.user_id == user_id).where(
+        Reservation.appointment_id == appointment_id)
+
+
+def new_reservation_statement(user_id, appointment_id, appointment_date_time, dialect_name):
+    """INSERT the reservation, or do nothing if the user already has one that day."""
+
+    return insert_or_do_nothing(Reservation, dialect_name).values(
+        user_id=user_id,
+        appointment_id=appointment_id,
+        reservation_date=appointment_date_time.date())
+
+
+def book_reservations(user, slot_keys):
+    """Book every slot in slot_keys that the user can have, with one commit.
+
+    The one-per-day rule is checked across the batch in memory (the first slot
+    on a day wins) and against the user's existing reservations in one query.
+    Appointment rows, stations and reservations are then written with a
+    statement each for the whole batch, not one per slot, and waitlist entries
+    on the booked days are used up. Returns
+    [(slot_key, reservation_id or None, outcome), ...] in slot_keys order,
+    where outcome is 'booked', 'not bookable', 'same day' or 'full'."""
+
+    outcomes = [(None, 'not bookable')] * len(slot_keys)
+    wanted = {}  # reservation_date -> (position in slot_keys, appointment_date_time)
+    for position, slot_key in enumerate(slot_keys):
+        slot = parse_slot_key(slot_key)
+        if slot is None or not schedule_rules.schedule_rule.is_bookable(slot):
+            continue
+        if slot.date() in wanted:
+            outcomes[position] = (None, 'same day')
+        else:
+            wanted[slot.date()] = (position, slot)
+
+    if wanted:
+        use_primary()
+        for day, booked_slot, reservation_id in db.session.execute(
+                reservation_dates_statement(user.user_id, wanted)):
+            position, slot = wanted.pop(day)
+            # The very slot asked for is a retry of a batch that went through, maybe on another worker:
+            outcomes[position] = (reservation_id, 'booked') if slot == booked_slot else (None, 'same day')
+
+    if wanted:
+        appointment_ids = get_or_create_appointment_ids(slot for _, slot in wanted.values())
+        wanted_by_id = {appointment_ids[slot]: (position, slot) for position, slot in wanted.values()}
+        claimed = take_stations(wanted_by_id)
+        reserved = insert_reservations(user.user_id, {
+            appointment_id: wanted_by_id[appointment_id][1] for appointment_id in claimed})
+        if claimed - set(reserved):
+            # Booked elsewhere on one of those days meanwhile; hand those stations back.
+            db.session.execute(give_back_station_statement(*(claimed - set(reserved))))
+        if reserved:
+            db.session.execute(used_waitlist_statement(user.user_id, *(
+                wanted_by_id[appointment_id][1].date() for appointment_id in reserved)))
+        now_full = db.session.execute(full_slots_statement(reserved)).scalars().all() if reserved else []
+        db.session.commit()
+
+        for appointment_id, (position, _) in wanted_by_id.items():
+            if appointment_id in reserved:
+                outcomes[position] = (reserved[appointment_id], 'booked')
+            elif appointment_id in claimed:
+                outcomes[position] = (None, 'same day')
+            else:
+                outcomes[position] = (None, 'full')
+        for slot in now_full:
+            slot_taken(slot)
+        if reserved:
+            versions.reservations_changed(user.user_id)
+
+    return [(slot_key, *outcome) for slot_key, outcome in zip(slot_keys, outcomes)]
+
+
+def get_or_create_appointment_ids(appointment_date_times, session=None):
+    """{appointment_date_time: appointment_id} for bookable slots, writing missing rows in one INSERT.
+
+    Doesn't commit; the rows go in with the caller's transaction. session defaults to db.session."""
+
+    session = session or db.session
+    appointment_date_times = list(appointment_date_times)
+    select_ids = select(Appointment.appointment_date_time, Appointment.appointment_id).where(
+        Appointment.appointment_date_time.in_(appointment_date_times))
+    appointment_ids = dict(session.execute(select_ids).all())
+    missing = [slot for slot in appointment_date_times if slot not in appointment_ids]
+    if missing:
+        session.execute(insert_or_do_nothing(Appointment, dialect_name(session)).values([
+            {'appointment_date_time': slot, 'capacity': schedule_rules.schedule_rule.stations}
+            for slot in missing]))
+        appointment_ids = dict(session.execute(select_ids).all())
+    return appointment_ids
+
+
+def take_stations(appointment_ids):
+    """take_station() at each appointment, as one UPDATE where the database can say which rows it changed.
+
+    Returns the set of appointment_ids that got a station."""
+
+    appointment_ids = list(appointment_ids)
+    if db.engine.dialect.full_returning:
+        return set(db.session.execute(take_station_statement(*appointment_ids).returning(
+            Appointment.appointment_id)).scalars())
+    return {appointment_id for appointment_id in appointment_ids if take_station(appointment_id)}
+
+
+def insert_reservations(user_id, appointments):
+    """INSERT a reservation at each of appointments ({appointment_id: appointment_date_time}).
+
+    One statement where the database can say which rows it wrote. Days the user
+    already has a reservation on are skipped. Returns {appointment_id: reservation_id}."""
+
+    if not appointments:
+        return {}
+    dialect_name = db.engine.dialect.name
+    if db.engine.dialect.full_returning:
+        return dict(db.session.execute(insert_or_do_nothing(Reservation, dialect_name).values([
+            {'user_id': user_id, 'appointment_id': appointment_id,
+             'reservation_date': appointment_date_time.date()}
+            for appointment_id, appointment_date_time in appointments.items()]).returning(
+                Reservation.appointment_id, Reservation.reservation_id)).all())
+
+    reserved = {}
+    for appointment_id, appointment_date_time in appointments.items():
+        result = db.session.execute(new_reservation_statement(
+            user_id, appointment_id, appointment_date_time, dialect_name))
+        if result.rowcount == 1:
+            reserved[appointment_id] = result.inserted_primary_key[0]
+    return reserved
+
+
+def reservation_dates_statement(user_id, reservation_dates):
+    """SELECT (reservation_date, appointment_date_time, reservation_id) of the user's reservations on reservation_dates."""
 
+    return select(Reservation.reservation_date, Appointment.appointment_date_time,
+                  Reservation.reservation_id).join(Reservation.appointment).where(
+                      Reservation.user_id == user_id).where(Reservation.reservation_date.in_(reservation_dates))
 
-def does_user_have_a_conflict_with_desired_appointment(user, desired_appointment):
-    """Returns True if there is a conflict."""
 
-    time_format = '%Y-%m-%d'
-    desired_day = desired_appointment.appointment_date_time.strftime(time_format)
-    return does_user_already_have_a_reservation_this_day(user, desired_day)
+def full_slots_statement(appointment_ids):
+    """SELECT the appointment_date_time of each of appointment_ids with no stations left."""
+
+    return select(Appointment.appointment_date_time).where(
+        Appointment.appointment_id.in_(appointment_ids)).where(
+            Appointment.booked_count >= Appointment.capacity)
 
 
 def does_user_already_have_a_reservation_this_day(user, desired_day):
-    """desired_day must be in computer readable format."""
+    """desired_day must be in computer readable format.
 
-    my_reservations = get_my_reservations(user=user, human_readable=False)
-    my_reservation_dates = [qq[0] for qq in my_reservations]
+    One EXISTS lookup on the (user_id, reservation_date) unique index, so it costs
+    the same however many reservations the user has made."""
 
-    if my_reservation_dates and desired_day in my_reservation_dates:
-        return True
-    else:
-        return False
+    reservation_date = datetime.strptime(desired_day, '%Y-%m-%d').date()
+    return db.session.execute(reservation_this_day_statement(user.user_id, reservation_date)).scalar()
 
 
-def does_this_reservation_exist_already(desired_appointment):
-    """Return a boolean we can use for the if-statement in can_user_book_this_reservation."""
+def reservation_this_day_statement(user_id, reservation_date):
+    """SELECT EXISTS: does the user have a reservation on reservation_date?"""
 
-    if Reservation.query.filter(
-            Reservation.appointment_id == desired_appointment.appointment_id).first():
-        return True  # Time slot already in use
-    else:
-        return False
+    return select(exists().where(Reservation.user_id == user_id).where(
+        Reservation.reservation_date == reservation_date))
 
 
 def get_my_reservations(user, human_readable=True):
-    """Show all reservations for a user in human-readable format."""
+    """Show all of a user's live reservations in human-readable format. Archived ones are left out."""
 
     my_reservations = db.session.query(
         Appointment.appointment_date_time, Reservation.reservation_id).filter(
@@ -265,6 +689,93 @@ def get_my_reservations(user, human_readable=True):
     return list_of_tuples
 
 
+def get_my_reservations_page(user, upcoming=True, cursor=None, page_size=MY_RESERVATIONS_PAGE_SIZE):
+    """One page of a user's reservations, in human-readable format.
+
+    Upcoming reservations come soonest first, past ones most recent first;
+    once the live past ones run out, the page carries on into the archive.
+    Returns (list_of_tuples, next_cursor); pass next_cursor back in for the
+    following page. next_cursor is None on the last page. Pages are found by
+    (appointment_date_time, reservation_id), not OFFSET, so page 50 costs the
+    same as page 1.
+    """
+
+    now = datetime.now()
+    after = parse_reservations_cursor(cursor) if cursor else None
+    rows = db.session.execute(my_reservations_page_statement(
+        user.user_id, upcoming, now, after, page_size + 1)).all()
+    if not upcoming and len(rows) <= page_size:
+        # Everything in the archive is older than everything still live:
+        rows += db.session.execute(archived_reservations_statement(
+            user.user_id, now, after, page_size + 1 - len(rows))).all()
+    return format_reservations_page(rows, page_size)
+
+
+def my_reservations_page_statement(user_id, upcoming, now, after, limit):
+    """SELECT (appointment_date_time, reservation_id) of live reservations for
+    get_my_reservations_page(), starting past the `after` position if given."""
+
+    position = tuple_(Appointment.appointment_date_time, Reservation.reservation_id)
+    statement = select(Appointment.appointment_date_time, Reservation.reservation_id).where(
+        Reservation.user_id == user_id).where(
+            Reservation.appointment_id == Appointment.appointment_id)
+
+    if upcoming:
+        statement = statement.where(Appointment.appointment_date_time >= now)
+        if after:
+            statement = statement.where(position > tuple_(*after))
+        statement = statement.order_by(Appointment.appointment_date_time, Reservation.reservation_id)
+    else:
+        statement = statement.where(Appointment.appointment_date_time < now)
+        if after:
+            statement = statement.where(position < tuple_(*after))
+        statement = statement.order_by(
+            Appointment.appointment_date_time.desc(), Reservation.reservation_id.desc())
+    return statement.limit(limit)
+
+
+def archived_reservations_statement(user_id, before, after, limit):
+    """SELECT (appointment_date_time, reservation_id) of the user's archived reservations
+    before `before`, most recent first, starting past the `after` position if given."""
+
+    statement = select(
+        ArchivedReservation.appointment_date_time, ArchivedReservation.reservation_id).where(
+            ArchivedReservation.user_id == user_id).where(
+                ArchivedReservation.appointment_date_time < before)
+    if after:
+        statement = statement.where(tuple_(
+            ArchivedReservation.appointment_date_time, ArchivedReservation.reservation_id) < tuple_(*after))
+    return statement.order_by(
+        ArchivedReservation.appointment_date_time.desc(),
+        ArchivedReservation.reservation_id.desc()).limit(limit)
+
+
+def format_reservations_page(rows, page_size):
+    """(list_of_tuples, next_cursor) from up to page_size + 1 rows of
+    (appointment_date_time, reservation_id)."""
+
+    page, more = rows[:page_size], len(rows) > page_size
+    next_cursor = format_reservations_cursor(*page[-1]) if more else None
+    list_of_tuples = [(format_human_datetime(jj[0]), jj[1]) for jj in page]
+    return list_of_tuples, next_cursor
+
+
+def format_reservations_cursor(appointment_date_time, reservation_id):
+    """'2021-12-25T13:30_42': where the next page of reservations starts."""
+
+    return f"{format_slot_key(appointment_date_time)}_{reservation_id}"
+
+
+def parse_reservations_cursor(cursor):
+    """(appointment_date_time, reservation_id) back out of a cursor. None if it doesn't parse."""
+
+    slot_key, _, reservation_id = cursor.partition('_')
+    appointment_date_time = parse_slot_key(slot_key)
+    if appointment_date_time is None or not reservation_id.isdigit():
+        return None
+    return appointment_date_time, int(reservation_id)
+
+
 """ -=-=-=-=-=-=-=-=-=-=-=-=-=-=- COMMON FUNCTIONS -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- """
 
 def format_human_datetime(datetime_object):
@@ -288,12 +799,41 @@ def format_computer_date(datetime_object):
     return format_date_time(datetime_object, strftime_format)
 
 
+def format_slot_key(datetime_object):
+    """'2021-12-25T13:30', for the value of a booking button."""
+
+    return format_date_time(datetime_object, SLOT_KEY_FORMAT)
+
+
+def parse_slot_key(slot_key):
+    """The datetime back out of format_slot_key(). None if it doesn't parse."""
+
+    try:
+        return datetime.strptime(slot_key, SLOT_KEY_FORMAT)
+    except ValueError:
+        return None
+
+
 def format_date_time(datetime_object, strftime_format):
     """Format a datetime object."""
 
     return datetime_object.strftime(strftime_format)
 
 
+def dialect_name(session):
+    """Which database session talks to: db.session, or one handed over by AsyncSession.run_sync()."""
+
+    return (session.bind or db.engine).dialect.name
+
+
+def insert_or_do_nothing(model_class, dialect_name=None):
+    """INSERT ... ON CONFLICT DO NOTHING for whichever database we're connected to."""
+
+    if (dialect_name or db.engine.dialect.name) == 'sqlite':
+        return sqlite.insert(model_class).on_conflict_do_nothing()
+    return postgresql.insert(model_class).on_conflict_do_nothing()
+
+
 if __name__ == '__main__':
     """Will connect you to the database when you run crud.py interactively"""
     from server import app
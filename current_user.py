@@ -0,0 +1,56 @@
+"""The logged-in user for Melon Tasting Reservations"""
+
+import os
+from collections import namedtuple
+
+from flask import g, session
+
+import crud
+from cache import TTLCache
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 4096))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))  # seconds
+
+# Everything the pages need to know about a user. Not a database object,
+# so it can outlive the request that loaded it.
+UserIdentity = namedtuple('UserIdentity', ['user_id', 'login_name'])
+
+identity_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def get_current_user():
+    """The logged-in user's UserIdentity, or None.
+
+    Loaded once per request, and from the database only when the identity
+    cache doesn't already have it."""
+
+    if 'current_user' in g:
+        return g.current_user
+
+    user_id = session.get("user_id")
+    identity = None
+    if user_id is not None:
+        identity = identity_cache.get(user_id)
+        if identity is None:
+            user = crud.get_user_by_id(user_id=user_id)
+            if user is not None:
+                identity = UserIdentity(user_id=user.user_id, login_name=user.login_name)
+                identity_cache.set(user_id, identity)
+
+    g.current_user = identity
+    return identity
+
+
+def remember_user(user):
+    """Call on login with the User we just checked, so the next page needn't load it again."""
+
+    identity = UserIdentity(user_id=user.user_id, login_name=user.login_name)
+    identity_cache.set(user.user_id, identity)
+    g.current_user = identity
+
+
+def forget_user(user_id):
+    """Call on logout, or whenever a user's row changes."""
+
+    identity_cache.pop(user_id)
+    g.pop('current_user', None)
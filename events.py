@@ -0,0 +1,144 @@
+"""Slot events for Melon Tasting Reservations
+
+crud publishes a "slot-taken" or "slot-freed" event every time a reservation
+is made or cancelled. /slot_events hands them to open select_appointment
+pages as server-sent events, so those pages drop or add buttons live.
+
+The broker lives in this process. With several server processes, a page only
+hears about bookings made by its own process; feed publish() from Postgres
+LISTEN/NOTIFY to hear everyone's.
+"""
+
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+SUBSCRIBER_QUEUE_SIZE = 100  # events a slow page may fall behind by before we drop some
+HEARTBEAT_SECONDS = 15  # keeps proxies from closing quiet connections
+STREAM_SECONDS = int(os.environ.get('SLOT_EVENTS_STREAM_SECONDS', 300))  # then the browser reconnects
+RECONNECT_MILLISECONDS = 5000
+
+
+class EventBroker:
+    """In-process publish/subscribe. Each subscriber gets its own bounded queue."""
+
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """A new queue that receives (event_type, data) from now on."""
+
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def subscribe_async(self):
+        """subscribe() for a coroutine: a LoopQueue on the running event loop."""
+
+        subscriber = LoopQueue(asyncio.get_running_loop(), self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Stop delivering to subscriber."""
+
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event_type, data):
+        """Hand the event to every subscriber. Never blocks the publisher."""
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event_type, data))
+            except queue.Full:
+                pass  # That page is too far behind to matter; it'll find out when it books.
+
+
+class LoopQueue:
+    """A bounded asyncio.Queue that publishers on any thread can put_nowait() into."""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put_nowait(self, item):
+        self.loop.call_soon_threadsafe(self.offer, item)
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            pass  # Same as EventBroker.publish(): too far behind to matter.
+
+
+slot_events = EventBroker()
+
+
+def publish_slot_event(event_type, slot_key, day, label):
+    """event_type is 'slot-taken' or 'slot-freed'."""
+
+    slot_events.publish(event_type, {'slot': slot_key, 'day': day, 'label': label})
+
+
+def stream_slot_events(day=None, heartbeat_seconds=HEARTBEAT_SECONDS, stream_seconds=STREAM_SECONDS):
+    """Yield server-sent event text for slot events on day (all days if None).
+
+    Ends after stream_seconds, so a worker thread isn't held for as long as a
+    page stays open; the browser's EventSource reconnects after the retry delay."""
+
+    subscriber = slot_events.subscribe()
+    ends_at = time.monotonic() + stream_seconds
+    try:
+        yield f"retry: {RECONNECT_MILLISECONDS}\n\n"
+        while True:
+            timeout = min(heartbeat_seconds, ends_at - time.monotonic())
+            if timeout <= 0:
+                return
+            try:
+                event_type, data = subscriber.get(timeout=timeout)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            if day is None or data['day'] == day:
+                yield format_slot_event(event_type, data)
+    finally:
+        slot_events.unsubscribe(subscriber)
+
+
+async def stream_slot_events_async(day=None, heartbeat_seconds=HEARTBEAT_SECONDS,
+                                   stream_seconds=STREAM_SECONDS):
+    """stream_slot_events() as an async generator, for async_server.py. Holds no thread while it waits."""
+
+    subscriber = slot_events.subscribe_async()
+    ends_at = time.monotonic() + stream_seconds
+    try:
+        yield f"retry: {RECONNECT_MILLISECONDS}\n\n"
+        while True:
+            timeout = min(heartbeat_seconds, ends_at - time.monotonic())
+            if timeout <= 0:
+                return
+            try:
+                event_type, data = await asyncio.wait_for(subscriber.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if day is None or data['day'] == day:
+                yield format_slot_event(event_type, data)
+    finally:
+        slot_events.unsubscribe(subscriber)
+
+
+def format_slot_event(event_type, data):
+    """One server-sent event."""
+
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,88 @@
+"""Streaming reservation export for Melon Tasting Reservations
+
+One joined query read through a server-side cursor, EXPORT_BATCH_SIZE rows at
+a time, so memory stays flat however many reservations there are.
+
+    $ python3 export.py > reservations.csv
+    $ python3 export.py --format jsonl > reservations.jsonl
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+
+from model import db, connect_to_db, User, Appointment, Reservation, ArchivedReservation
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = ['reservation_id', 'user_id', 'login_name', 'appointment_id', 'appointment_date_time']
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def iter_reservation_rows():
+    """Yield one tuple per reservation, in EXPORT_COLUMNS order.
+
+    Archived reservations first, then live ones, each by reservation_id.
+    No ORM objects, so no lazy loads of .user or .appointment per row."""
+
+    yield from db.session.query(
+        ArchivedReservation.reservation_id, User.user_id, User.login_name,
+        ArchivedReservation.appointment_id, ArchivedReservation.appointment_date_time).join(
+            User, ArchivedReservation.user_id == User.user_id).order_by(
+                ArchivedReservation.reservation_id).execution_options(
+                    stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+    yield from db.session.query(
+        Reservation.reservation_id, User.user_id, User.login_name,
+        Appointment.appointment_id, Appointment.appointment_date_time).join(
+            User, Reservation.user_id == User.user_id).join(
+                Appointment, Reservation.appointment_id == Appointment.appointment_id).order_by(
+                    Reservation.reservation_id).execution_options(
+                        stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+
+def iter_csv():
+    """The export as CSV text, a header line and then one chunk per row."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in iter_reservation_rows():
+        writer.writerow(row[:-1] + (row[-1].isoformat(),))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl():
+    """The export as JSON lines, one object per reservation."""
+
+    for row in iter_reservation_rows():
+        record = dict(zip(EXPORT_COLUMNS, row))
+        record['appointment_date_time'] = record['appointment_date_time'].isoformat()
+        yield json.dumps(record) + "\n"
+
+
+def iter_export(export_format):
+    """iter_csv() or iter_jsonl()."""
+
+    return iter_jsonl() if export_format == 'jsonl' else iter_csv()
+
+
+def parse_args(argv=None):
+    """Command line options; see the module docstring."""
+
+    parser = argparse.ArgumentParser(description="Write every reservation to stdout.")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    from server import app
+
+    args = parse_args()
+    connect_to_db(app)
+    with app.app_context():
+        for chunk in iter_export(args.format):
+            sys.stdout.write(chunk)
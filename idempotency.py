@@ -0,0 +1,135 @@
+"""Idempotency keys for Melon Tasting Reservations
+
+Booking and cancelling forms carry an idempotency_key (or an Idempotency-Key
+header). The first request with a key claims it before doing any work, and
+its outcome is remembered for IDEMPOTENCY_TTL seconds; a retry with the same
+key gets that outcome back from a cache lookup instead of being run again.
+A retry that arrives while the first request is still running waits up to
+IDEMPOTENCY_WAIT seconds for its outcome.
+
+The cache is per process. A retry that lands on another worker runs again,
+so the booking path also treats "you already have exactly this slot" as
+success (see crud.can_user_book_this_reservation).
+"""
+
+import asyncio
+import os
+import time
+from uuid import uuid4
+
+from flask import g, request, session
+
+from cache import TTLCache
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 3600))  # seconds
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 100000))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 5))  # seconds a retry waits for the first try
+POLL_SECONDS = 0.05
+
+idempotent_outcomes = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+IN_PROGRESS = object()  # claim()'s answer when the first request outlasted IDEMPOTENCY_WAIT
+
+
+class Pending:
+    """Holds a key while its first request runs. Each claim gets its own, so only it can be replaced."""
+
+
+def new_key():
+    """A fresh key for a form to send along."""
+
+    return uuid4().hex
+
+
+def request_key():
+    """The current request's key, scoped to its user, route and other form values.
+
+    A page's forms share one key, so booking a second slot from the same page is
+    a new request, not a retry of the first. None if the request sent no key."""
+
+    return make_key(session.get('user_id'), request.path, request.headers, request.values)
+
+
+def make_key(user_id, path, headers, values):
+    """request_key() from its parts, for code that isn't running in a Flask request."""
+
+    key = headers.get('Idempotency-Key') or values.get('idempotency_key')
+    if not key:
+        return None
+    other_values = tuple(sorted(
+        (name, value) for name, value in values.items(multi=True)
+        if name != 'idempotency_key'))
+    return user_id, path, other_values, key
+
+
+def try_claim(key):
+    """One attempt at claiming key.
+
+    Returns (Pending, None) if the work is now ours, or (None, what key holds):
+    an outcome, another request's Pending, or None if it just expired."""
+
+    pending = Pending()
+    if idempotent_outcomes.add(key, pending):
+        return pending, None
+    return None, idempotent_outcomes.get(key)
+
+
+def is_outcome(value):
+    """True for a remembered outcome; False for a claim in progress or nothing."""
+
+    return value is not None and not isinstance(value, Pending)
+
+
+def claim():
+    """Claim this request's key before doing the work.
+
+    Returns None if the work is this request's to do (or it sent no key).
+    Otherwise it's a retry: returns the first request's outcome, waiting for
+    it if need be, or IN_PROGRESS if it's still running after IDEMPOTENCY_WAIT."""
+
+    key = request_key()
+    if key is None:
+        return None
+    gives_up_at = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        pending, value = try_claim(key)
+        if pending:
+            g.idempotency_claim = key, pending
+            return None
+        if is_outcome(value):
+            return value
+        if time.monotonic() >= gives_up_at:
+            return IN_PROGRESS
+        time.sleep(POLL_SECONDS)
+
+
+async def claim_async(key):
+    """claim() for a key from make_key(), in a coroutine.
+
+    Returns (Pending, None) if the work is ours, else (None, outcome or IN_PROGRESS)."""
+
+    if key is None:
+        return None, None
+    gives_up_at = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        pending, value = try_claim(key)
+        if pending or is_outcome(value):
+            return pending, value
+        if time.monotonic() >= gives_up_at:
+            return None, IN_PROGRESS
+        await asyncio.sleep(POLL_SECONDS)
+
+
+def remember(outcome):
+    """Save outcome for retries of this request, if it claimed its key. Never overwrites another outcome."""
+
+    key, pending = g.pop('idempotency_claim', (None, None))
+    if key:
+        idempotent_outcomes.replace(key, pending, outcome)
+
+
+def release():
+    """Drop this request's claim if it never remembered an outcome (turned away, or failed), so a retry runs."""
+
+    key, pending = g.pop('idempotency_claim', (None, None))
+    if key:
+        idempotent_outcomes.discard(key, pending)
@@ -0,0 +1,121 @@
+"""SQL instrumentation for Melon Tasting Reservations
+
+Counts and times every statement a Flask request runs, and reports:
+
+* X-SQL-Queries / X-SQL-Time-ms response headers and one log line per request,
+* running totals per route, served on /metrics,
+* a slow-query log (SLOW_QUERY_MS) keyed by statement fingerprint,
+* a warning when one request runs the same statement N_PLUS_ONE_THRESHOLD
+  times or more, the usual sign of an N+1 lazy load.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+logger = logging.getLogger('melon.sql')
+
+route_totals = {}  # route -> {'requests', 'queries', 'sql_ms'}
+route_totals_lock = threading.Lock()
+
+
+def fingerprint(statement):
+    """The statement with literals and IN lists squashed, so repeats group together."""
+
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+\b", "?", statement)
+    statement = re.sub(r"%\(\w+\)s|%s|:\w+", "?", statement)
+    statement = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(...)", statement)
+    return re.sub(r"\s+", " ", statement).strip()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    """Runs just before any engine sends a statement."""
+
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    """Runs when the statement comes back; charges it to the current request."""
+
+    elapsed_ms = (time.perf_counter() - conn.info['query_start_times'].pop()) * 1000
+    statement_fingerprint = fingerprint(statement)
+
+    if elapsed_ms >= SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms): %s", elapsed_ms, statement_fingerprint)
+
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_ms += elapsed_ms
+        g.sql_fingerprints[statement_fingerprint] += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def drop_timer(exception_context):
+    """Runs when a statement raises instead of coming back; its start time would never be popped."""
+
+    conn = exception_context.connection
+    start_times = conn.info.get('query_start_times') if conn is not None else None
+    if start_times:
+        start_times.pop()
+
+
+def start_request():
+    """Fresh counters for each request."""
+
+    g.sql_queries = 0
+    g.sql_ms = 0.0
+    g.sql_fingerprints = Counter()
+
+
+def finish_request(response):
+    """Report this request's SQL and add it to the route totals."""
+
+    if 'sql_queries' not in g:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else '<no route>'
+    response.headers['X-SQL-Queries'] = str(g.sql_queries)
+    response.headers['X-SQL-Time-ms'] = f"{g.sql_ms:.1f}"
+    logger.info("%s %s: %d queries, %.1f ms in SQL", request.method, route, g.sql_queries, g.sql_ms)
+
+    for statement_fingerprint, count in g.sql_fingerprints.items():
+        if count >= N_PLUS_ONE_THRESHOLD:
+            logger.warning("Possible N+1 on %s: ran %d times: %s", route, count, statement_fingerprint)
+
+    with route_totals_lock:
+        totals = route_totals.setdefault(route, {'requests': 0, 'queries': 0, 'sql_ms': 0.0})
+        totals['requests'] += 1
+        totals['queries'] += g.sql_queries
+        totals['sql_ms'] += g.sql_ms
+    return response
+
+
+def route_stats():
+    """Per-route request count, queries and SQL time, with per-request averages."""
+
+    with route_totals_lock:
+        return {
+            route: dict(totals,
+                        queries_per_request=totals['queries'] / totals['requests'],
+                        sql_ms_per_request=totals['sql_ms'] / totals['requests'])
+            for route, totals in route_totals.items()}
+
+
+def install(flask_app):
+    """Start counting queries for every request flask_app handles."""
+
+    flask_app.before_request(start_request)
+    flask_app.after_request(finish_request)
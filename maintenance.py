@@ -0,0 +1,133 @@
+"""Partition and archive maintenance for Melon Tasting Reservations
+
+appointments and reservations only hold the live working set: slots from
+ARCHIVE_AFTER_DAYS ago to the end of the booking horizon. Run this daily (cron
+is fine) to move older slots and their reservations into archived_appointments
+and archived_reservations, and to create the archive partitions the coming
+months will need. On Postgres the archive tables are partitioned by month, so
+an old month can be detached or dropped in one statement. Elsewhere they are
+plain tables. Waitlist entries for days that have gone by are deleted.
+
+    $ python3 maintenance.py
+"""
+
+import os
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import delete, func, insert, select, text
+
+from model import (db, connect_to_db, Appointment, Reservation, WaitlistEntry,
+                   ArchivedAppointment, ArchivedReservation)
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 30))  # days past tastings stay live
+PARTITION_MONTHS_AHEAD = 3  # archive partitions kept ready past the current month
+PARTITIONED_TABLES = ['archived_appointments', 'archived_reservations']
+
+
+def archive_cutoff(now=None):
+    """Slots that start before this belong in the archive."""
+
+    today = (now or datetime.now()).date()
+    return datetime.combine(today - timedelta(days=ARCHIVE_AFTER_DAYS), time(0))
+
+
+def month_start(day):
+    """The first of day's month."""
+
+    return date(day.year, day.month, 1)
+
+
+def next_month(month):
+    """The first of the month after month."""
+
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def create_partitions(first_day, last_day):
+    """Make sure every archive table has a partition for each month from first_day to last_day.
+
+    Postgres only; returns the partition names, or [] on other databases."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return []
+
+    partitions = []
+    month = month_start(first_day)
+    while month <= last_day:
+        for table in PARTITIONED_TABLES:
+            partition = f"{table}_{month:%Y_%m}"
+            db.session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"))
+            partitions.append(partition)
+        month = next_month(month)
+    db.session.commit()
+    return partitions
+
+
+def archive_past_slots(now=None):
+    """Move appointments that started before archive_cutoff(), and their reservations, into the archive.
+
+    Copies and deletes in one transaction, with set-based statements. Returns
+    (appointments moved, reservations moved)."""
+
+    cutoff = archive_cutoff(now)
+    oldest = db.session.query(func.min(Appointment.appointment_date_time)).filter(
+        Appointment.appointment_date_time < cutoff).scalar()
+    if oldest is None:
+        return 0, 0
+    create_partitions(oldest.date(), cutoff.date())
+
+    is_past = Appointment.appointment_date_time < cutoff
+    moved_reservations = db.session.execute(insert(ArchivedReservation).from_select(
+        ['reservation_id', 'appointment_date_time', 'user_id', 'appointment_id', 'reservation_date'],
+        select(Reservation.reservation_id, Appointment.appointment_date_time, Reservation.user_id,
+               Reservation.appointment_id, Reservation.reservation_date).join(
+                   Appointment, Reservation.appointment_id == Appointment.appointment_id).where(
+                       is_past))).rowcount
+    db.session.execute(insert(ArchivedAppointment).from_select(
+        ['appointment_id', 'appointment_date_time', 'capacity', 'booked_count'],
+        select(Appointment.appointment_id, Appointment.appointment_date_time,
+               Appointment.capacity, Appointment.booked_count).where(is_past)))
+
+    db.session.execute(delete(Reservation).where(Reservation.appointment_id.in_(
+        select(Appointment.appointment_id).where(is_past))).execution_options(
+            synchronize_session=False))
+    moved_appointments = db.session.execute(delete(Appointment).where(is_past).execution_options(
+        synchronize_session=False)).rowcount
+    db.session.commit()
+    return moved_appointments, moved_reservations
+
+
+def delete_past_waits(now=None):
+    """Delete waitlist entries for days before today; nothing can open up for them. Returns how many."""
+
+    today = (now or datetime.now()).date()
+    deleted = db.session.execute(delete(WaitlistEntry).where(
+        WaitlistEntry.wait_date < today).execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def run_maintenance(now=None):
+    """Partitions for this month and the next PARTITION_MONTHS_AHEAD, archive_past_slots(), delete_past_waits()."""
+
+    today = (now or datetime.now()).date()
+    last_month = month_start(today)
+    for _ in range(PARTITION_MONTHS_AHEAD):
+        last_month = next_month(last_month)
+    partitions = create_partitions(today, last_month)
+    moved_appointments, moved_reservations = archive_past_slots(now)
+    deleted_waits = delete_past_waits(now)
+    return partitions, moved_appointments, moved_reservations, deleted_waits
+
+
+if __name__ == '__main__':
+    from server import app
+
+    connect_to_db(app)
+    partitions, moved_appointments, moved_reservations, deleted_waits = run_maintenance()
+    print(f"Archive partitions ready: {', '.join(partitions) or 'none needed'}")
+    print(f"Archived {moved_appointments} appointments and {moved_reservations} reservations "
+          f"from before {archive_cutoff():%Y-%m-%d}.")
+    print(f"Deleted {deleted_waits} waitlist entries for past days.")
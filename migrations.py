@@ -0,0 +1,213 @@
+"""Versioned schema migrations for Melon Tasting Reservations
+
+model.py always describes the newest schema, and db.create_all() builds it from
+scratch. The MIGRATIONS below bring an existing, populated database up to the
+same schema in place. Each one runs once, in order, and is recorded in the
+schema_version table.
+
+    $ python3 migrations.py           # apply anything new
+    $ python3 migrations.py explain   # same, printing query plans before and after
+    $ python3 migrations.py stamp     # mark a create_all() database as up to date
+"""
+
+import sys
+from datetime import datetime
+
+from sqlalchemy import text
+
+from model import db, connect_to_db, SchemaVersion
+
+MIGRATIONS = [
+    (1, "One reservation per time slot and per user per calendar day", [
+        "ALTER TABLE reservations ADD COLUMN IF NOT EXISTS reservation_date DATE",
+        """UPDATE reservations SET reservation_date = appointments.appointment_date_time::date
+           FROM appointments
+           WHERE appointments.appointment_id = reservations.appointment_id
+           AND reservations.reservation_date IS NULL""",
+        # NULLs never collide in a unique constraint, so a row without a date would dodge the one-per-day rule:
+        "ALTER TABLE reservations ALTER COLUMN reservation_date SET NOT NULL",
+        """ALTER TABLE reservations ADD CONSTRAINT reservations_appointment_id_key
+           UNIQUE (appointment_id)""",
+        """ALTER TABLE reservations ADD CONSTRAINT reservations_user_id_reservation_date_key
+           UNIQUE (user_id, reservation_date)""",
+    ]),
+    (2, "Indexes for availability searches and my reservations", [
+        """CREATE INDEX IF NOT EXISTS ix_appointments_appointment_date_time
+           ON appointments (appointment_date_time)""",
+        """CREATE INDEX IF NOT EXISTS ix_reservations_user_id_appointment_id
+           ON reservations (user_id, appointment_id)""",
+        "ANALYZE appointments",
+        "ANALYZE reservations",
+    ]),
+    (3, "Appointment slots come from schedule_rules.py; keep rows for booked slots only", [
+        """DELETE FROM appointments WHERE NOT EXISTS (
+           SELECT 1 FROM reservations WHERE reservations.appointment_id = appointments.appointment_id)""",
+        "DROP INDEX IF EXISTS ix_appointments_appointment_date_time",
+        """CREATE UNIQUE INDEX ix_appointments_appointment_date_time
+           ON appointments (appointment_date_time)""",
+    ]),
+    (4, "Slot capacity: several tasting stations can share a time slot", [
+        "ALTER TABLE appointments ADD COLUMN IF NOT EXISTS capacity INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE appointments ADD COLUMN IF NOT EXISTS booked_count INTEGER NOT NULL DEFAULT 0",
+        """UPDATE appointments SET booked_count = (
+           SELECT count(*) FROM reservations WHERE reservations.appointment_id = appointments.appointment_id)""",
+        """ALTER TABLE appointments ADD CONSTRAINT appointments_booked_count_check
+           CHECK (booked_count BETWEEN 0 AND capacity)""",
+        """CREATE INDEX IF NOT EXISTS ix_appointments_full_slots
+           ON appointments (appointment_date_time) WHERE booked_count >= capacity""",
+        "ALTER TABLE reservations DROP CONSTRAINT IF EXISTS reservations_appointment_id_key",
+        """CREATE INDEX IF NOT EXISTS ix_reservations_appointment_id
+           ON reservations (appointment_id)""",
+        "ANALYZE appointments",
+    ]),
+    (5, "Monthly-partitioned archive tables for past slots; see maintenance.py", [
+        """CREATE TABLE IF NOT EXISTS archived_appointments (
+           appointment_id INTEGER NOT NULL,
+           appointment_date_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+           capacity INTEGER NOT NULL,
+           booked_count INTEGER NOT NULL,
+           PRIMARY KEY (appointment_id, appointment_date_time)
+           ) PARTITION BY RANGE (appointment_date_time)""",
+        """CREATE TABLE IF NOT EXISTS archived_reservations (
+           reservation_id INTEGER NOT NULL,
+           appointment_date_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+           user_id INTEGER NOT NULL REFERENCES users (user_id),
+           appointment_id INTEGER NOT NULL,
+           reservation_date DATE NOT NULL,
+           PRIMARY KEY (reservation_id, appointment_date_time)
+           ) PARTITION BY RANGE (appointment_date_time)""",
+        """CREATE INDEX IF NOT EXISTS ix_archived_reservations_user_id_appointment_date_time
+           ON archived_reservations (user_id, appointment_date_time, reservation_id)""",
+    ]),
+    (6, "Waitlist: cancellations book the earliest waiter for that slot", [
+        """CREATE TABLE IF NOT EXISTS waitlist (
+           waitlist_id SERIAL PRIMARY KEY,
+           user_id INTEGER NOT NULL REFERENCES users (user_id),
+           wait_date DATE NOT NULL,
+           start_time TIME WITHOUT TIME ZONE NOT NULL,
+           end_time TIME WITHOUT TIME ZONE NOT NULL,
+           created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+           CONSTRAINT waitlist_user_id_wait_date_key UNIQUE (user_id, wait_date)
+           )""",
+        """CREATE INDEX IF NOT EXISTS ix_waitlist_wait_date_created_at
+           ON waitlist (wait_date, created_at)""",
+    ]),
+]
+
+# The queries behind our busiest pages, for `python3 migrations.py explain`. Each
+# is {schema version it needs: SQL}; the "before" pass runs the version the
+# database is at, so the plans compare the same work on the old and new schema.
+HOT_QUERIES = {
+    "upcoming full slots": {
+        0: """
+        SELECT appointment_date_time FROM appointments
+        WHERE appointment_date_time >= :day_start AND EXISTS (
+            SELECT 1 FROM reservations WHERE reservations.appointment_id = appointments.appointment_id)""",
+        4: """
+        SELECT appointment_date_time FROM appointments
+        WHERE appointment_date_time >= :day_start AND booked_count >= capacity""",
+    },
+    "my reservations": {
+        0: """
+        SELECT appointments.appointment_date_time, reservations.reservation_id
+        FROM reservations JOIN appointments USING (appointment_id)
+        WHERE reservations.user_id = :user_id
+        ORDER BY appointments.appointment_date_time""",
+    },
+    "stations left at a slot": {
+        0: """
+        SELECT 1 - count(*) FROM reservations WHERE appointment_id = :appointment_id""",
+        4: """
+        SELECT capacity - booked_count FROM appointments WHERE appointment_id = :appointment_id""",
+    },
+}
+
+
+def hot_queries(version):
+    """{name: SQL} from HOT_QUERIES, each the newest variant a database at version can run."""
+
+    return {
+        name: variants[max(since for since in variants if since <= version)]
+        for name, variants in HOT_QUERIES.items()}
+
+
+def current_version():
+    """The newest migration applied to this database; 0 for none."""
+
+    version = db.session.query(db.func.max(SchemaVersion.version)).scalar()
+    return version or 0
+
+
+def upgrade():
+    """Apply every migration newer than current_version(), each in its own transaction."""
+
+    SchemaVersion.__table__.create(bind=db.engine, checkfirst=True)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version():
+            continue
+        print(f"Migrating to version {version}: {description}")
+        for statement in statements:
+            db.session.execute(text(statement))
+        db.session.add(SchemaVersion(
+            version=version, description=description, applied_at=datetime.now()))
+        db.session.commit()
+        applied.append(version)
+    return applied
+
+
+def stamp():
+    """Record every migration as applied without running it.
+
+    For databases built by db.create_all(), which already match model.py."""
+
+    already_applied = {version for (version,) in db.session.query(SchemaVersion.version)}
+    for version, description, _ in MIGRATIONS:
+        if version not in already_applied:
+            db.session.add(SchemaVersion(
+                version=version, description=description, applied_at=datetime.now()))
+    db.session.commit()
+
+
+def explain_hot_queries():
+    """Print the Postgres query plan of each HOT_QUERIES entry against real rows."""
+
+    SchemaVersion.__table__.create(bind=db.engine, checkfirst=True)  # A database that never migrated is at 0.
+    sample = db.session.execute(text("""
+        SELECT reservations.user_id, reservations.appointment_id,
+               appointments.appointment_date_time::date AS day
+        FROM reservations JOIN appointments USING (appointment_id)
+        LIMIT 1""")).first()
+    if sample is None:
+        print("No reservations to explain; seed the database first.")
+        return
+    params = {
+        'user_id': sample.user_id,
+        'appointment_id': sample.appointment_id,
+        'day_start': datetime.combine(sample.day, datetime.min.time()),
+    }
+    for name, query in hot_queries(current_version()).items():
+        print(f"-- {name}")
+        for (line,) in db.session.execute(text(f"EXPLAIN ANALYZE {query}"), params):
+            print(line)
+        print()
+    db.session.rollback()
+
+
+if __name__ == '__main__':
+    from server import app
+
+    connect_to_db(app, echo=False)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+
+    if command == 'stamp':
+        stamp()
+    elif command == 'explain':
+        print("======== BEFORE ========")
+        explain_hot_queries()
+        upgrade()
+        print("======== AFTER ========")
+        explain_hot_queries()
+    else:
+        upgrade()
+    print(f"Schema is at version {current_version()}.")
@@ -1,8 +1,89 @@
 """Models for Melon Tasting Reservations"""
 
-from flask_sqlalchemy import SQLAlchemy
+import os
+import random
+import time
 
-db = SQLAlchemy()
+from flask import current_app, has_request_context, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+REPLICA_URIS = [uri for uri in os.environ.get('DATABASE_REPLICA_URIS', '').split(',') if uri]
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))  # connections kept open per engine
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))  # extra connections under load
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # seconds; beats server-side idle timeouts
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'  # check a connection before using it
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))  # longer than replica lag
+
+
+class RoutingSession(SignallingSession):
+    """Sends plain SELECTs to a replica and everything else to the primary.
+
+    Once the session writes (a flush, an INSERT/UPDATE/DELETE, SELECT ... FOR
+    UPDATE, raw SQL), it stays on the primary, so it always reads its own
+    writes. A browser that just wrote is kept on the primary for
+    READ_YOUR_WRITES_SECONDS too, so the page after a booking shows it. A
+    session given an explicit bind isn't routed at all.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.routed = options.get('bind') is None
+        self.replica_key = None
+        self.on_primary = False
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:  # session.execute(..., bind=...) picked one itself.
+            return bind
+        replica_keys = self.app.config.get('REPLICA_BIND_KEYS')
+        if self.routed and replica_keys and not self.on_primary:
+            if self._flushing or not is_plain_select(clause):
+                self.on_primary = True
+            elif not recently_wrote():
+                if self.replica_key is None:
+                    self.replica_key = random.choice(replica_keys)
+                return self.db.get_engine(self.app, bind=self.replica_key)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def use_primary():
+    """Send the rest of this session's queries to the primary.
+
+    Call before reading rows you're about to change, so they can't be a stale replica copy."""
+
+    db.session().on_primary = True
+
+
+def primary_bind():
+    """The primary engine (or whatever the session is bound to), to read one statement from.
+
+    session.execute(statement, bind=primary_bind()) reads fresh rows without
+    moving the rest of the session, or the browser, off the replicas."""
+
+    return SignallingSession.get_bind(db.session())
+
+
+def is_plain_select(clause):
+    """True for a SELECT that doesn't lock rows."""
+
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+
+def recently_wrote():
+    """True inside a request from a browser that wrote in the last READ_YOUR_WRITES_SECONDS."""
+
+    return has_request_context() and session.get('read_primary_until', 0) > time.time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with RoutingSession."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 
 class User(db.Model):
@@ -27,12 +108,25 @@ class Appointment(db.Model):
     __tablename__ = 'appointments'
 
     appointment_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    appointment_date_time = db.Column(db.DateTime, nullable=False)
+    # Rows are written the first time a slot is booked; see schedule_rules.py.
+    appointment_date_time = db.Column(db.DateTime, nullable=False, unique=True, index=True)
+    # How many tasting stations share the slot, and how many of them are booked.
+    # crud keeps booked_count in step with conditional UPDATEs; nothing counts reservations.
+    capacity = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    booked_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     # reservations = a list of Reservation objects
 
+    __table_args__ = (
+        db.CheckConstraint("booked_count BETWEEN 0 AND capacity", name="appointments_booked_count_check"),
+        # The availability index loads upcoming full slots; this keeps that scan to full rows only.
+        db.Index("ix_appointments_full_slots", "appointment_date_time",
+                 postgresql_where=db.text("booked_count >= capacity"),
+                 sqlite_where=db.text("booked_count >= capacity")),
+    )
+
     def __repr__(self):
-        return f'{self.appointment_id}. {self.appointment_date_time}'
+        return f'{self.appointment_id}. {self.appointment_date_time} ({self.booked_count}/{self.capacity} booked)'
 
 
 class Reservation(db.Model):
@@ -42,32 +136,152 @@ class Reservation(db.Model):
 
     reservation_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"))
-    appointment_id = db.Column(db.Integer, db.ForeignKey("appointments.appointment_id"))
+    # Up to appointment.capacity reservations per time slot:
+    appointment_id = db.Column(db.Integer, db.ForeignKey("appointments.appointment_id"), index=True)
+    # Copy of the appointment's calendar day so the database can enforce one reservation per user per day:
+    reservation_date = db.Column(db.Date, nullable=False)
 
     user = db.relationship("User", backref="reservations")
     appointment = db.relationship("Appointment", backref="reservations")
 
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "reservation_date", name="reservations_user_id_reservation_date_key"),
+        # "My reservations" and the day-conflict check look up by user_id; this also covers user_id alone.
+        db.Index("ix_reservations_user_id_appointment_id", "user_id", "appointment_id"),
+    )
+
     def __repr__(self):
         return f'{self.reservation_id}. Expect {self.user.login_name} at {self.appointment.appointment_date_time}.'
 
 
-def connect_to_db(flask_app, db_uri="postgresql:///reservations", echo=True):
-    """Connect to reservations DB."""
+class WaitlistEntry(db.Model):
+    """A user waiting for any slot between start_time and end_time on wait_date.
+
+    When a cancellation frees a slot, crud books it for the earliest eligible entry."""
+
+    __tablename__ = 'waitlist'
+
+    waitlist_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    wait_date = db.Column(db.Date, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    user = db.relationship("User", backref="waitlist_entries")
+
+    __table_args__ = (
+        # One reservation per user per day, so one wait per user per day too:
+        db.UniqueConstraint("user_id", "wait_date", name="waitlist_user_id_wait_date_key"),
+        # A cancellation looks up that day's waiters, first come first served:
+        db.Index("ix_waitlist_wait_date_created_at", "wait_date", "created_at"),
+    )
+
+    def __repr__(self):
+        return f'{self.waitlist_id}. User {self.user_id} waiting on {self.wait_date} {self.start_time}-{self.end_time}'
+
+
+class ArchivedAppointment(db.Model):
+    """A past appointment, moved out of appointments by maintenance.py.
+
+    On Postgres this is partitioned by month of appointment_date_time."""
+
+    __tablename__ = 'archived_appointments'
+
+    appointment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # Partitioned tables need the partition key in their primary key:
+    appointment_date_time = db.Column(db.DateTime, primary_key=True)
+    capacity = db.Column(db.Integer, nullable=False)
+    booked_count = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = {'postgresql_partition_by': 'RANGE (appointment_date_time)'}
+
+    def __repr__(self):
+        return f'{self.appointment_id}. {self.appointment_date_time} (archived)'
+
+
+class ArchivedReservation(db.Model):
+    """A past reservation, moved out of reservations by maintenance.py.
+
+    Keeps a copy of its appointment_date_time, so past pages of my reservations
+    need no join. On Postgres this is partitioned by month of appointment_date_time."""
+
+    __tablename__ = 'archived_reservations'
+
+    reservation_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    appointment_date_time = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    appointment_id = db.Column(db.Integer, nullable=False)
+    reservation_date = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_archived_reservations_user_id_appointment_date_time",
+                 "user_id", "appointment_date_time", "reservation_id"),
+        {'postgresql_partition_by': 'RANGE (appointment_date_time)'},
+    )
+
+    def __repr__(self):
+        return f'{self.reservation_id}. User {self.user_id} at {self.appointment_date_time} (archived)'
+
+
+class SchemaVersion(db.Model):
+    """A migration from migrations.py that has been applied to this database."""
+
+    __tablename__ = 'schema_version'
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'{self.version}. {self.description}'
+
+
+def connect_to_db(flask_app, db_uri="postgresql:///reservations", echo=False,
+                  replica_uris=REPLICA_URIS, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                  pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING):
+    """Connect to reservations DB, and to its read replicas if there are any.
+
+    replica_uris can also come from DATABASE_REPLICA_URIS, comma separated;
+    see RoutingSession for which queries go where."""
     flask_app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
     flask_app.config["SQLALCHEMY_ECHO"] = echo
     flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    engine_options = {'pool_pre_ping': pool_pre_ping, 'pool_recycle': pool_recycle}
+    if not db_uri.startswith('sqlite'):  # SQLite files get no connection pool to size.
+        engine_options.update(pool_size=pool_size, max_overflow=max_overflow)
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+    use_replicas(flask_app, replica_uris)
 
     db.app = flask_app
     db.init_app(flask_app)
+    if keep_writers_on_the_primary not in flask_app.after_request_funcs.get(None, []):
+        flask_app.after_request(keep_writers_on_the_primary)  # Once, however often we reconnect.
 
     print("Connected to the db!")
 
 
+def keep_writers_on_the_primary(response):
+    """After each request: a browser that just wrote reads from the primary until the replicas have caught up."""
+
+    if getattr(db.session(), 'on_primary', False) and current_app.config['REPLICA_BIND_KEYS']:
+        session['read_primary_until'] = time.time() + READ_YOUR_WRITES_SECONDS
+    return response
+
+
+def use_replicas(flask_app, replica_uris):
+    """Route reads to replica_uris from now on; [] sends everything to the primary."""
+
+    binds = {f'replica_{n}': uri for n, uri in enumerate(replica_uris)}
+    flask_app.config["SQLALCHEMY_BINDS"] = binds or None
+    flask_app.config["REPLICA_BIND_KEYS"] = list(binds)
+
+
 if __name__ == "__main__":
     from server import app
 
-    # Call connect_to_db(app, echo=False) if your program output gets
-    # too annoying; this will tell SQLAlchemy not to print out every
-    # query it executes.
+    # Call connect_to_db(app, echo=True) to have SQLAlchemy print out every
+    # query it executes. The server reports query counts and slow queries
+    # on its own; see instrumentation.py.
 
     connect_to_db(app)
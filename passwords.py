@@ -0,0 +1,174 @@
+"""Password hashing service for Melon Tasting Reservations"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))  # bcrypt's default cost.
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', 2))  # 0 hashes on the calling thread.
+# Hashes running + waiting. The default lets one more wait behind each worker, so nobody queues for long:
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', 2 * max(PASSWORD_WORKERS, 1)))
+PASSWORD_TIMEOUT = float(os.environ.get('PASSWORD_TIMEOUT', 10))  # seconds a login waits on the pool
+
+
+class PasswordServiceBusy(Exception):
+    """Too many hashes already waiting, or the pool took longer than PASSWORD_TIMEOUT; try again shortly."""
+
+
+def hash_with_rounds(password, rounds):
+    """Hash and Salt plaintext password using bcrypt at the given cost."""
+
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password.encode('utf8'), salt).decode('utf8')
+
+
+def check_password(password, hashed_password):
+    """bcrypt.checkpw on strings."""
+
+    return bcrypt.checkpw(password.encode('utf8'), hashed_password.encode('utf8'))
+
+
+def rounds_of(hashed_password):
+    """The cost factor baked into a hash like '$2b$12$...'."""
+
+    return int(hashed_password.split('$')[2])
+
+
+class PasswordHasher:
+    """Runs bcrypt in a small process pool so it can't tie up every request thread.
+
+    At most queue_limit hashes can be running or waiting at once; past that we
+    raise PasswordServiceBusy right away instead of queueing the request. A
+    caller waits at most timeout seconds for its hash before giving up the
+    same way; the hash still counts against queue_limit until it's done.
+    """
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT,
+                 timeout=PASSWORD_TIMEOUT):
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(queue_limit)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def hash(self, password):
+        """Hash password at the configured cost."""
+
+        return self.run(hash_with_rounds, password, self.rounds)
+
+    def verify(self, password, hashed_password):
+        """Returns bool."""
+
+        return self.run(check_password, password, hashed_password)
+
+    def needs_rehash(self, hashed_password):
+        """True if hashed_password was made with a different cost than we use now."""
+
+        return rounds_of(hashed_password) != self.rounds
+
+    async def hash_async(self, password):
+        """hash() for asyncio code: waits on the pool without blocking the event loop."""
+
+        return await self.run_async(hash_with_rounds, password, self.rounds)
+
+    async def verify_async(self, password, hashed_password):
+        """verify() for asyncio code."""
+
+        return await self.run_async(check_password, password, hashed_password)
+
+    def run(self, function, *args):
+        """Run function(*args) in the pool, counting it against queue_limit."""
+
+        if self.workers:
+            try:
+                return self.submit(function, *args).result(timeout=self.timeout)
+            except TimeoutError:
+                raise PasswordServiceBusy(f"no password hash within {self.timeout} seconds") from None
+        self.admit()
+        try:
+            return function(*args)
+        finally:
+            self.finish()
+
+    async def run_async(self, function, *args):
+        """run() for asyncio code. With no pool workers it runs on the loop's default thread pool."""
+
+        if self.workers:
+            future = asyncio.wrap_future(self.submit(function, *args))
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                raise PasswordServiceBusy(f"no password hash within {self.timeout} seconds") from None
+        self.admit()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+        finally:
+            self.finish()
+
+    def submit(self, function, *args):
+        """Start function(*args) in the pool, counting it against queue_limit until it's done."""
+
+        self.admit()
+        try:
+            future = self.get_executor().submit(function, *args)
+        except BaseException:
+            self.finish()
+            raise
+        future.add_done_callback(lambda _: self.finish())
+        return future
+
+    def admit(self):
+        """Count a hash against queue_limit, or raise PasswordServiceBusy."""
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PasswordServiceBusy(f"{self.queue_limit} password hashes already in progress")
+
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finish(self):
+        """Call once for every admit()."""
+
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self.slots.release()
+
+    def get_executor(self):
+        """The pool starts on first use, so it's created after gunicorn forks its workers."""
+
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def stats(self):
+        """Queue depth and throughput counters."""
+
+        with self.lock:
+            return {
+                'rounds': self.rounds,
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'in_flight': self.in_flight,
+                'queued': max(0, self.in_flight - self.workers) if self.workers else 0,
+                'peak_in_flight': self.peak_in_flight,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+
+password_hasher = PasswordHasher()
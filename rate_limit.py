@@ -0,0 +1,98 @@
+"""Rate limiting for Melon Tasting Reservations
+
+Token buckets keyed by login_name and by client address. A bucket holds up to
+`burst` tokens and refills at `per_minute` tokens a minute; each attempt takes
+one. Checking costs a dictionary lookup, so a rejected request never reaches
+bcrypt or the database.
+
+Behind a load balancer or reverse proxy every request comes from the proxy's
+address. Set TRUSTED_PROXIES to how many proxies sit in front of the server,
+and the client address is read from X-Forwarded-For instead; see
+client_address().
+"""
+
+import abc
+import os
+import threading
+import time
+from collections import OrderedDict
+
+LOGIN_PER_MINUTE = float(os.environ.get('LOGIN_PER_MINUTE', 6))  # per login_name
+LOGIN_BURST = int(os.environ.get('LOGIN_BURST', 5))
+ADDRESS_LOGIN_PER_MINUTE = float(os.environ.get('ADDRESS_LOGIN_PER_MINUTE', 30))  # per client address
+ADDRESS_LOGIN_BURST = int(os.environ.get('ADDRESS_LOGIN_BURST', 10))
+BOOKING_PER_MINUTE = float(os.environ.get('BOOKING_PER_MINUTE', 30))  # per user and per address
+BOOKING_BURST = int(os.environ.get('BOOKING_BURST', 10))
+MAX_TRACKED_KEYS = 100000  # buckets kept in memory; the least recently used go first
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))  # proxies that append to X-Forwarded-For
+
+
+class BucketStore(abc.ABC):
+    """Where buckets live. Subclass and implement take() against a shared store
+    (Redis, memcached...) to rate limit across every server process."""
+
+    @abc.abstractmethod
+    def take(self, key, per_minute, burst, now):
+        """Take a token from key's bucket if there is one. Returns bool."""
+
+
+class InMemoryBucketStore(BucketStore):
+    """Buckets in this process's memory."""
+
+    def __init__(self, max_keys=MAX_TRACKED_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, last_refill)
+        self.lock = threading.Lock()
+
+    def take(self, key, per_minute, burst, now):
+        with self.lock:
+            tokens, last_refill = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last_refill) * per_minute / 60)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)  # A forgotten bucket is a full one.
+            return allowed
+
+
+class RateLimiter:
+    """Named limits, each a (per_minute, burst) pair, over one BucketStore."""
+
+    def __init__(self, limits, store=None, clock=time.monotonic):
+        self.limits = limits
+        self.store = store or InMemoryBucketStore()
+        self.clock = clock
+
+    def allow(self, limit_name, *keys):
+        """True if every key still has a token under limit_name.
+
+        Takes a token from each bucket it checks; stops at the first empty one."""
+
+        per_minute, burst = self.limits[limit_name]
+        now = self.clock()
+        return all(
+            self.store.take(f"{limit_name}:{key}", per_minute, burst, now) for key in keys)
+
+
+def client_address(remote_addr, forwarded_for, trusted_proxies=TRUSTED_PROXIES):
+    """The address to rate limit a request by.
+
+    With trusted_proxies in front of us, that's the address the outermost of
+    them saw: the trusted_proxies-th entry from the end of X-Forwarded-For
+    (forwarded_for), the same one werkzeug's ProxyFix picks. Entries further
+    left came from the client and could be anything. Otherwise remote_addr."""
+
+    values = [value.strip() for value in (forwarded_for or '').split(',') if value.strip()]
+    if trusted_proxies and len(values) >= trusted_proxies:
+        return values[-trusted_proxies]
+    return remote_addr
+
+
+rate_limiter = RateLimiter({
+    'login_name': (LOGIN_PER_MINUTE, LOGIN_BURST),
+    'login_address': (ADDRESS_LOGIN_PER_MINUTE, ADDRESS_LOGIN_BURST),
+    'booking': (BOOKING_PER_MINUTE, BOOKING_BURST),
+})
@@ -0,0 +1,84 @@
+"""Schedule rules for Melon Tasting Reservations
+
+Appointment slots aren't stored ahead of time. They're computed from a
+ScheduleRule whenever someone searches, and an Appointment row is only
+written the first time a slot is booked. The schedule rolls forward every
+day on its own; there is nothing to reseed.
+"""
+
+import os
+from datetime import datetime, time, timedelta
+
+SLOT_MINUTES = 30  # mins, flexible design for changes later.
+HORIZON_DAYS = 30  # days. One Month of selectable appointment slots.
+TASTING_STATIONS = int(os.environ.get('TASTING_STATIONS', 1))  # people who can book the same slot
+
+
+class ScheduleRule:
+    """When we're open for tastings.
+
+    Slots start at opens_at and every slot_minutes after that; the last slot
+    of the day must end by closes_at (None means midnight). Nothing is
+    scheduled on blackout_dates. Bookings are taken from now until
+    horizon_days after today. Each slot has `stations` tasting stations, so
+    that many people can book it.
+    """
+
+    def __init__(self, slot_minutes=SLOT_MINUTES, opens_at=time(0), closes_at=None,
+                 blackout_dates=(), horizon_days=HORIZON_DAYS, stations=TASTING_STATIONS):
+        self.slot_minutes = slot_minutes
+        self.opens_at = opens_at
+        self.closes_at = closes_at
+        self.blackout_dates = set(blackout_dates)
+        self.horizon_days = horizon_days
+        self.stations = stations
+
+    def slots_on(self, day):
+        """Every slot start on day, in order."""
+
+        if day in self.blackout_dates:
+            return []
+        slot_length = timedelta(minutes=self.slot_minutes)
+        slot_start = datetime.combine(day, self.opens_at)
+        if self.closes_at is None:
+            day_end = datetime.combine(day + timedelta(days=1), time(0))
+        else:
+            day_end = datetime.combine(day, self.closes_at)
+
+        slots = []
+        while slot_start + slot_length <= day_end:
+            slots.append(slot_start)
+            slot_start += slot_length
+        return slots
+
+    def slots_between(self, start, end):
+        """Every slot start from start to end, inclusive, in order."""
+
+        slots = []
+        day = start.date()
+        while day <= end.date():
+            slots.extend(slot for slot in self.slots_on(day) if start <= slot <= end)
+            day += timedelta(days=1)
+        return slots
+
+    def is_slot(self, appointment_date_time):
+        """True if appointment_date_time is the start of a scheduled slot."""
+
+        return appointment_date_time in self.slots_on(appointment_date_time.date())
+
+    def last_day(self, now=None):
+        """The last calendar day we take bookings for."""
+
+        today = (now or datetime.now()).date()
+        return today + timedelta(days=self.horizon_days)
+
+    def is_bookable(self, appointment_date_time, now=None):
+        """A scheduled slot that hasn't started yet and is inside the horizon."""
+
+        now = now or datetime.now()
+        return (now < appointment_date_time
+                and appointment_date_time.date() <= self.last_day(now)
+                and self.is_slot(appointment_date_time))
+
+
+schedule_rule = ScheduleRule()
@@ -2,19 +2,26 @@
 
 import os
 from random import choice
-from datetime import datetime, timedelta, date
+from datetime import datetime, time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from sqlalchemy import func, select, update
 
 import crud
+import migrations
 import model
+import schedule_rules
 import server
+from passwords import hash_with_rounds
 
 DB_NAME = 'reservations'
-SEED_APPOINTMENTS = 30  # days. One Month of selectable appointment slots.
-APPOINTMENT_DURATION = 30  # mins, flexible design for changes later.
 SEED_USERS = 50  # 48 available appointment slots per day;
 # must have enough users to create some likely collisions.
 SEED_RESERVATIONS = 10
 POSSIBLE_PASSWORDS = ['sweet', 'juicy']
+SEED_BCRYPT_ROUNDS = 12  # bcrypt's default. Drop to 4 for 100k fake users in seconds.
+INSERT_CHUNK_SIZE = 10000  # rows per multi-row INSERT
 
 
 def seed_database():
@@ -24,39 +31,85 @@ def seed_database():
 
     model.connect_to_db(server.app)
     model.db.create_all()
+    migrations.stamp()  # create_all() already built the newest schema.
 
-    seed_appointments()
+    # No appointments to seed; they come from schedule_rules.schedule_rule.
     seed_users_and_reservations()
 
 
-def seed_appointments():
-    """Create SEED_APPOINTMENTS days worth of APPOINTMENT_DURATION appointments."""
-
-    tomorrow_at_midnight = datetime.combine((date.today() + timedelta(days=1)), datetime.min.time())
-    end_date = tomorrow_at_midnight + timedelta(days=SEED_APPOINTMENTS)
-    count_appointments = 0
-    appointment_date_time = tomorrow_at_midnight
-    while appointment_date_time < end_date:
-        appointment_date_time = tomorrow_at_midnight + timedelta(minutes=APPOINTMENT_DURATION * count_appointments)
-        new_appointment = crud.create_appointment(appointment_date_time)
-        model.db.session.add(new_appointment)
-        count_appointments += 1
+def seed_users_and_reservations():
+    """Create SEED_USERS users and SEED_RESERVATIONS reservations.
+
+    Each user gets SEED_RESERVATIONS random tries; a try that lands on a full slot
+    or a day the user already booked is dropped, just like it would be on the site.
+    """
+
+    login_names = ['Melon Taster ' + str(n + 1) for n in range(SEED_USERS)]
+    passwords = [choice(POSSIBLE_PASSWORDS) for _ in login_names]
+    hashed_passwords = hash_passwords(passwords)
+    bulk_insert(model.User, [
+        {'login_name': login_name, 'hashed_password': hashed_password}
+        for login_name, hashed_password in zip(login_names, hashed_passwords)])
+
+    user_ids = [user_id for (user_id,) in model.db.session.query(model.User.user_id).filter(
+        model.User.login_name.in_(login_names)).order_by(model.User.user_id)]
+    now = datetime.now()
+    rule = schedule_rules.schedule_rule
+    all_slots = rule.slots_between(now, datetime.combine(rule.last_day(now), time.max))
+    booked_counts = dict(model.db.session.query(
+        model.Appointment.appointment_date_time, model.Appointment.booked_count))
+
+    reservations = []  # (user_id, appointment_date_time)
+    for user_id in user_ids:
+        booked_days = set()
+        for _ in range(SEED_RESERVATIONS):
+            appointment_date_time = choice(all_slots)
+            booked_count = booked_counts.get(appointment_date_time, 0)
+            if booked_count >= rule.stations or appointment_date_time.date() in booked_days:
+                continue  # No reservation for you!
+            booked_counts[appointment_date_time] = booked_count + 1
+            booked_days.add(appointment_date_time.date())
+            reservations.append((user_id, appointment_date_time))
+
+    # Booked slots get their appointment rows, then the reservations point at them:
+    bulk_insert(model.Appointment, [
+        {'appointment_date_time': appointment_date_time, 'capacity': rule.stations}
+        for appointment_date_time in {slot for _, slot in reservations}])
+    appointment_ids = dict(model.db.session.query(
+        model.Appointment.appointment_date_time, model.Appointment.appointment_id).filter(
+            model.Appointment.appointment_date_time >= now))
+    bulk_insert(model.Reservation, [
+        {'user_id': user_id,
+         'appointment_id': appointment_ids[appointment_date_time],
+         'reservation_date': appointment_date_time.date()}
+        for user_id, appointment_date_time in reservations])
+    # One set-based UPDATE brings every booked_count in line with what was just inserted:
+    reservations_per_appointment = select(func.count()).where(
+        model.Reservation.appointment_id == model.Appointment.appointment_id).scalar_subquery()
+    model.db.session.execute(update(model.Appointment).where(
+        model.Appointment.appointment_date_time >= now).values(
+            booked_count=reservations_per_appointment).execution_options(synchronize_session=False))
     model.db.session.commit()
+    crud.forget_cached_availability()
 
 
-def seed_users_and_reservations():
-    """Create SEED_USERS users and SEED_RESERVATIONS reservations."""
+def hash_passwords(passwords):
+    """bcrypt is the slow part of seeding, so spread it over every CPU."""
 
-    for n in range(SEED_USERS):
-        login_name = 'Melon Taster ' + str(n + 1)
-        password = choice(POSSIBLE_PASSWORDS)
-        new_user = crud.check_then_create_user(login_name, password)
-        model.db.session.add(new_user)
+    with ProcessPoolExecutor() as pool:
+        return list(pool.map(
+            partial(hash_with_rounds, rounds=SEED_BCRYPT_ROUNDS), passwords,
+            chunksize=max(1, len(passwords) // (4 * (os.cpu_count() or 1)))))
 
-        all_appointments = crud.get_appointments()
-        for _ in range(SEED_RESERVATIONS):
-            random_appointment = choice(all_appointments)
-            crud.can_user_book_this_reservation(user=new_user, desired_appointment=random_appointment)
+
+def bulk_insert(model_class, rows):
+    """INSERT rows in INSERT_CHUNK_SIZE batches. psycopg2 sends each batch as one multi-row VALUES.
+
+    Rows that would break a unique constraint are skipped, so seeding twice is harmless."""
+
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        model.db.session.execute(
+            crud.insert_or_do_nothing(model_class), rows[start:start + INSERT_CHUNK_SIZE])
 
 
 if __name__ == '__main__':
@@ -1,16 +1,35 @@
 #!/usr/bin/python3.9
 """Server for Melon Tasting Reservations"""
 
+import logging
 import os
-from flask import Flask, render_template, request, flash, session, redirect
+from datetime import datetime, timedelta
+from flask import (Flask, render_template, request, flash, session, redirect, jsonify,
+                   Response, abort, make_response, stream_with_context)
 from model import Reservation, connect_to_db, db
+from availability import availability_index
+from passwords import password_hasher, PasswordServiceBusy
+from rate_limit import rate_limiter, TRUSTED_PROXIES
+from current_user import get_current_user, remember_user, forget_user
 import crud
+import events
+import export
+import idempotency
+import instrumentation
+import versions
 
 from jinja2 import StrictUndefined
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 app.secret_key = os.environ['APP_SECRET_KEY']
 app.jinja_env.undefined = StrictUndefined
+if TRUSTED_PROXIES:  # request.remote_addr is the client, not the proxy in front of us:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+instrumentation.install(app)
+
+# Comma-separated login_names allowed to download every reservation:
+ADMIN_LOGIN_NAMES = set(filter(None, os.environ.get('ADMIN_LOGIN_NAMES', '').split(',')))
 
 user_logged_in = None
 
@@ -37,10 +56,24 @@ def login_process():
 
     login_name = request.form["login_name"]
     password = request.form["password"]
+
+    # Before any database or bcrypt work:
+    if not (rate_limiter.allow('login_address', request.remote_addr)
+            and rate_limiter.allow('login_name', login_name)):
+        flash("Too many login attempts. Please wait a minute and try again.")
+        return redirect("/")
+
     user = crud.get_user_by_login_name(login_name=login_name)
 
-    if crud.does_password_match(user=user, password_from_form=password):
+    try:
+        password_matched = crud.does_password_match(user=user, password_from_form=password)
+    except PasswordServiceBusy:
+        flash("We're swamped with logins right now. Please try again in a moment.")
+        return redirect("/")
+
+    if password_matched:
         session["user_id"] = user.user_id
+        remember_user(user)
         return redirect("/my_reservations")
     else:
         flash("Oops, Login Name and Password didn't match.")
@@ -52,6 +85,7 @@ def logout():
     """Log out user."""
 
     if "user_id" in session:
+        forget_user(session["user_id"])
         del session["user_id"]
     flash("See you soon!")
     return redirect("/")
@@ -59,59 +93,191 @@ def logout():
 
 @app.route("/my_reservations")
 def my_reservations():
-    """Display user's reservations."""
+    """Display a page of the user's reservations.
+
+    ?when=past shows past tastings instead of upcoming ones; ?after=<cursor> is the next page."""
+
+    upcoming = request.args.get("when") != "past"
+    etag = versions.page_etag(session, 'my_reservations', upcoming, request.args.get("after"))
+    if versions.is_fresh(session, request.if_none_match, etag):
+        return not_modified(etag)
 
-    user = crud.get_user_by_id(user_id=session["user_id"])
-    my_reservations = crud.get_my_reservations(user=user)
-    return render_template(
+    user = get_current_user()
+    my_reservations, next_cursor = crud.get_my_reservations_page(
+        user=user, upcoming=upcoming, cursor=request.args.get("after"))
+    return with_etag(etag, render_template(
         'my_reservations.html', user=user, my_reservations=my_reservations,
-        user_logged_in=is_user_logged_in())
+        upcoming=upcoming, next_cursor=next_cursor, idempotency_key=idempotency.new_key(),
+        user_logged_in=is_user_logged_in()))
 
 
 @app.route("/select_appointment", methods=["GET"])
 def select_appointment():
     """Users search for free appointments."""
 
-    user = crud.get_user_by_id(user_id=session["user_id"])
     date = request.args["pick-date"]
     time1 = request.args["pick-time1"]
     time2 = request.args["pick-time2"]
+    etag = versions.page_etag(session, 'select_appointment', date, time1, time2,
+                              availability=availability_index.full_slots_on(date))
+    if versions.is_fresh(session, request.if_none_match, etag):
+        return not_modified(etag)
+
+    user = get_current_user()
+    # One reservation per day, so there is nothing to offer or wait for on a day they've booked:
+    day_taken = crud.does_user_already_have_a_reservation_this_day(user, date)
+    avaliable_times = False if day_taken else crud.list_free_appointments(
+        date, start_time=min(time1, time2), end_time=max(time1, time2))
+
+    return with_etag(etag, render_template('select_appointment.html',
+                                           avaliable_times=avaliable_times,
+                                           day_taken=day_taken,
+                                           desired_day=date,
+                                           start_time=min(time1, time2),
+                                           end_time=max(time1, time2),
+                                           idempotency_key=idempotency.new_key(),
+                                           user_logged_in=is_user_logged_in()))
+
+
+def not_modified(etag):
+    """304: the browser's copy is still good."""
+
+    return with_etag(etag, Response(status=304))
+
+
+def with_etag(etag, response):
+    """Tag a per-user page so the browser revalidates it with If-None-Match and nothing else caches it."""
 
-    avaliable_times = crud.search_for_available_appointments(
-        user, desired_day=date, start_time=min(time1, time2), end_time=max(time1, time2))
+    response = make_response(response)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-    return render_template('select_appointment.html',
-                           avaliable_times=avaliable_times,
-                           user_logged_in=is_user_logged_in())
+
+@app.route("/slot_events")
+def slot_events():
+    """Server-sent events as slots are taken and freed. ?day=YYYY-MM-DD narrows to one day."""
+
+    return Response(
+        stream_with_context(events.stream_slot_events(day=request.args.get("day"))),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/availability_calendar")
+def availability_calendar():
+    """Free slot counts per day for a whole month, for drawing a calendar.
+
+    ?month=YYYY-MM (defaults to this month); optional pick-time1, pick-time2
+    narrow each day to a time window; slots=1 includes the bookable slots too.
+    """
+
+    user = get_current_user()
+    if user is None:
+        abort(401)
+    month = request.args.get("month") or datetime.now().strftime("%Y-%m")
+    try:
+        first_day = datetime.strptime(month, "%Y-%m").date()
+    except ValueError:
+        abort(400)
+    last_day = (first_day + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+    time1 = request.args.get("pick-time1") or "00:00"
+    time2 = request.args.get("pick-time2") or "23:59"
+
+    calendar = crud.get_availability_calendar(
+        user, first_day, last_day, start_time=min(time1, time2), end_time=max(time1, time2),
+        include_slots=request.args.get("slots") == "1")
+    return jsonify(month=month, days=calendar)
 
 
 @app.route("/specify_time_window")
 def specify_time_window():
     """Input time search parameters."""
 
+    etag = versions.page_etag(session, 'specify_time_window')
+    if versions.is_fresh(session, request.if_none_match, etag):
+        return not_modified(etag)
+
     min_date, max_date, _, max_date_raw = crud.min_max_date_range()
-    return render_template('specify_time_window.html',
-                           min_date=min_date,
-                           max_date=max_date,
-                           max_human_date = crud.format_human_date(max_date_raw),
-                           user_logged_in=is_user_logged_in())
+    return with_etag(etag, render_template('specify_time_window.html',
+                                           min_date=min_date,
+                                           max_date=max_date,
+                                           max_human_date = crud.format_human_date(max_date_raw),
+                                           user_logged_in=is_user_logged_in()))
 
 
 @app.route('/record_appointment', methods=['POST'])
 def record_appointment():
     """Book a reservation"""
 
-    user = crud.get_user_by_id(user_id=session["user_id"])
-    desired_appointment_id = request.form['book_this_appointment']
-    desired_appointment = crud.get_appointment_by_id(
-        appointment_id=int(desired_appointment_id))
-    human_reservation_datetime = crud.format_human_datetime(
-        desired_appointment.appointment_date_time)
+    replayed = idempotency.claim()
+    if replayed:
+        return respond_to_retry(replayed)
+
+    if not rate_limiter.allow(
+            'booking', f'user:{session["user_id"]}', f'address:{request.remote_addr}'):
+        flash("You're booking faster than we can pour. Please wait a minute and try again.")
+        return redirect("/my_reservations")
+
+    user = get_current_user()
+    desired_slot = crud.parse_slot_key(request.form['book_this_appointment'])
+    if desired_slot is None:
+        return respond("Sorry, we couldn't find that appointment.", "/specify_time_window")
+    desired_appointment = crud.get_or_create_appointment(desired_slot)
+    human_reservation_datetime = crud.format_human_datetime(desired_slot)
+
+    if desired_appointment and crud.can_user_book_this_reservation(
+            user=user, desired_appointment=desired_appointment):
+        return respond(f"You got it! See you on {human_reservation_datetime}", "/my_reservations")
+    return respond(f"Sorry, We could not get you {human_reservation_datetime}", "/my_reservations")
+
+
+@app.route('/record_appointments', methods=['POST'])
+def record_appointments():
+    """Book several slots at once: one book_this_appointment field per slot.
 
-    if crud.can_user_book_this_reservation(user=user, desired_appointment=desired_appointment):
-        flash(f"You got it! See you on {human_reservation_datetime}")
+    Answers with JSON, one result per slot in the order they were sent."""
+
+    replayed = idempotency.claim()
+    if replayed is idempotency.IN_PROGRESS:
+        abort(409)
+    if replayed:
+        return jsonify(results=replayed)
+
+    user = get_current_user()
+    if user is None:
+        abort(401)
+    slot_keys = request.form.getlist('book_this_appointment')
+    if not slot_keys or len(slot_keys) > crud.MAX_BATCH_BOOKINGS:
+        abort(400)
+    if not rate_limiter.allow('booking', f'user:{user.user_id}', f'address:{request.remote_addr}'):
+        abort(429)
+
+    results = [{'slot': slot_key, 'reservation_id': reservation_id, 'outcome': outcome}
+               for slot_key, reservation_id, outcome in crud.book_reservations(user, slot_keys)]
+    idempotency.remember(results)
+    return jsonify(results=results)
+
+
+@app.route('/join_waitlist', methods=['POST'])
+def join_waitlist():
+    """Wait for a slot in a time window that had none free."""
+
+    user = get_current_user()
+    if user is None:
+        return redirect("/")
+    date = request.form["pick-date"]
+    time1 = request.form["pick-time1"]
+    time2 = request.form["pick-time2"]
+    human_date = crud.format_human_date(datetime.strptime(date, '%Y-%m-%d'))
+
+    joined = crud.join_waitlist(user, desired_day=date, start_time=min(time1, time2), end_time=max(time1, time2))
+    if joined:
+        flash(f"You're on the waitlist for {human_date}. If a slot in your window opens up, it's yours.")
+    elif joined is None:
+        flash(f"Sorry, we aren't taking reservations for {human_date}.")
     else:
-        flash(f"Sorry, We could not get you {human_reservation_datetime}")
+        flash(f"You already have a tasting on {human_date}.")
     return redirect("/my_reservations")
 
 
@@ -119,11 +285,73 @@ def record_appointment():
 def cancel_reservation(reservation_id):
     """Cancel a reservation."""
 
+    replayed = idempotency.claim()
+    if replayed:
+        return respond_to_retry(replayed)
+
     crud.delete_reservation(reservation_id)
-    return redirect("/my_reservations")
+    return respond(None, "/my_reservations")
+
+
+def respond(message, location):
+    """Flash message (if any) and redirect to location.
+
+    The same outcome is replayed for retries that carry this request's idempotency key."""
+
+    idempotency.remember((message, location))
+    if message:
+        flash(message)
+    return redirect(location)
+
+
+def respond_to_retry(outcome):
+    """A retry gets the first request's outcome, or a heads-up if that's still running."""
+
+    if outcome is idempotency.IN_PROGRESS:
+        flash("We're still working on that. Check your reservations again in a moment.")
+        return redirect("/my_reservations")
+    return respond(*outcome)
+
+
+@app.teardown_request
+def release_idempotency_claim(error):
+    """A request that claimed an idempotency key but has no outcome (turned away, failed) lets it go."""
+
+    idempotency.release()
+
+
+@app.route("/admin/export_reservations")
+def export_reservations():
+    """Stream every reservation as CSV, or JSON lines with ?format=jsonl. Admins only."""
+
+    abort_unless_admin()
+    export_format = request.args.get("format", "csv")
+    if export_format not in export.EXPORT_FORMATS:
+        abort(400)
+    return Response(
+        stream_with_context(export.iter_export(export_format)),
+        mimetype=export.EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=reservations.{export_format}"})
+
+
+@app.route("/metrics")
+def metrics():
+    """Counters for keeping an eye on the server. Admins only."""
+
+    abort_unless_admin()
+    return jsonify(passwords=password_hasher.stats(), sql=instrumentation.route_stats())
+
+
+def abort_unless_admin():
+    """403 unless the logged-in user is in ADMIN_LOGIN_NAMES."""
+
+    user = get_current_user()
+    if user is None or user.login_name not in ADMIN_LOGIN_NAMES:
+        abort(403)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     connect_to_db(app)
 
     app.jinja_env.auto_reload = True
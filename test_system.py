@@ -1,45 +1,132 @@
 """Tests for the Melon Tasting Reservations"""
 
+import asyncio
+import os
+import time
 import unittest
+import unittest.mock
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, exc, insert, select, text, update
 
 from server import app
-from model import db, connect_to_db
+from model import (db, connect_to_db, use_replicas, User, Appointment, Reservation, ArchivedReservation,
+                   WaitlistEntry)
+from passwords import password_hasher, rounds_of, PasswordServiceBusy
+from availability import availability_index
+from rate_limit import InMemoryBucketStore, RateLimiter, client_address, rate_limiter
+import async_server
 import crud
+import current_user
+import events
+import export
+import idempotency
+import instrumentation
+import maintenance
+import schedule_rules
 import seed_database
+import versions
+
+# Parallel runs (pytest -n auto) get a database per worker:
+TEST_DB_NAME = "test_reservations" + (
+    f"_{os.environ['PYTEST_XDIST_WORKER']}" if 'PYTEST_XDIST_WORKER' in os.environ else "")
+TEST_BCRYPT_ROUNDS = 4  # bcrypt's minimum
 
 
 class TestReservationsDB(unittest.TestCase):
-    """Flask tests that use the database."""
+    """Flask tests that use the database.
 
-    def setUp(self):
-        """This runs before every def test_* function."""
+    The schema and seed data are built once for the whole class. Each test runs
+    inside a transaction that is rolled back afterwards, so tests can't see each
+    other's writes and nothing has to be dropped or reseeded in between.
+    """
 
-        self.client = app.test_client()
+    @classmethod
+    def setUpClass(cls):
+        """This runs once, before any def test_* function."""
+
+        os.system(f"createdb {TEST_DB_NAME} 2> /dev/null")  # One database per parallel worker.
+        connect_to_db(flask_app=app, db_uri=f"postgresql:///{TEST_DB_NAME}")
         app.config['TESTING'] = True
 
-        connect_to_db(flask_app=app, db_uri=f"postgresql:///test_reservations")
-        db.create_all()
+        # Cheap bcrypt; the tests check hashes, not how slow they are to make:
+        cls.configured_rounds, cls.configured_workers = password_hasher.rounds, password_hasher.workers
+        password_hasher.rounds, password_hasher.workers = TEST_BCRYPT_ROUNDS, 0
 
-        seed_database.SEED_APPOINTMENTS = 3  # days
-        seed_database.APPOINTMENT_DURATION = 60  # mins
+        db.drop_all()
+        db.create_all()
+        schedule_rules.schedule_rule = cls.make_schedule_rule()
         seed_database.SEED_USERS = 3
         seed_database.SEED_RESERVATIONS = 10
         seed_database.POSSIBLE_PASSWORDS = ['secret', 'secret', 'secret']
-        seed_database.seed_appointments()
+        seed_database.SEED_BCRYPT_ROUNDS = TEST_BCRYPT_ROUNDS
         seed_database.seed_users_and_reservations()
 
+    @staticmethod
+    def make_schedule_rule():
+        """Hour-long slots, three days out."""
+
+        return schedule_rules.ScheduleRule(slot_minutes=60, horizon_days=3)
+
+    def setUp(self):
+        """This runs before every def test_* function."""
+
+        self.client = app.test_client()
+
+        # Everything this test writes stays in this transaction:
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        db.session = db.create_scoped_session(options={'bind': self.connection, 'binds': {}})
+
+        # In-process state starts fresh too:
+        schedule_rules.schedule_rule = self.make_schedule_rule()
+        crud.forget_cached_availability()
+        current_user.identity_cache.clear()
+        idempotency.idempotent_outcomes.clear()
+        rate_limiter.store = InMemoryBucketStore()  # Every test logs in and books from 127.0.0.1.
+
+        self.tomorrow = date.today() + timedelta(days=1)
+
     def test_appointments(self):
         """Tests for appointment crud"""
 
+        rule = schedule_rules.schedule_rule
+
         # Create all the appointments promised:
-        minutes_of_window = seed_database.SEED_APPOINTMENTS * 60 * 24
-        number_of_windows = minutes_of_window / seed_database.APPOINTMENT_DURATION
-        self.assertEqual(number_of_windows + 1, len(crud.get_appointments()))
+        number_of_windows = 60 * 24 / rule.slot_minutes
+        self.assertEqual(number_of_windows, len(rule.slots_on(self.tomorrow)))
 
         # No duplicate appointment slots:
-        appointment_date_times = [
-            appointment.appointment_date_time for appointment in crud.get_appointments()]
-        self.assertFalse(self.are_there_dupes(a_list=appointment_date_times))
+        all_slots = rule.slots_between(
+            datetime.now(), datetime.combine(rule.last_day(), datetime.max.time()))
+        self.assertFalse(self.are_there_dupes(a_list=all_slots))
+
+        # Only slots that have been booked get a row:
+        self.assertEqual(len(crud.get_reservations()), len(crud.get_appointments()))
+        self.assertIsNone(crud.get_or_create_appointment(
+            datetime.combine(self.tomorrow, datetime.min.time()) + timedelta(minutes=1)))
+        self.assertIsNone(crud.get_or_create_appointment(
+            datetime.combine(rule.last_day() + timedelta(days=1), datetime.min.time())))
+        new_slot = datetime.combine(self.tomorrow, datetime.min.time())
+        appointment = crud.get_or_create_appointment(new_slot)
+        self.assertEqual(new_slot, appointment.appointment_date_time)
+        self.assertEqual(appointment.appointment_id, crud.get_or_create_appointment(
+            new_slot).appointment_id)
+
+        # The scheduling horizon comes from the rule:
+        _, max_date, _, _ = crud.min_max_date_range()
+        self.assertEqual(crud.format_computer_date(date.today() + timedelta(days=3)), max_date)
+
+        # Opening hours and blackout dates:
+        rule.opens_at = datetime.strptime("09:00", "%H:%M").time()
+        rule.closes_at = datetime.strptime("17:00", "%H:%M").time()
+        self.assertEqual(8, len(rule.slots_on(self.tomorrow)))
+        rule.blackout_dates.add(self.tomorrow)
+        self.assertEqual([], rule.slots_on(self.tomorrow))
+        new_user = crud.check_then_create_user(login_name='Melon Taster Closed', password="xxx")
+        self.assertFalse(crud.search_for_available_appointments(
+            new_user, desired_day=crud.format_computer_date(self.tomorrow)))
 
     def test_users(self):
         """Tests for user crud"""
@@ -79,6 +166,110 @@ class TestReservationsDB(unittest.TestCase):
         login_names = [user.login_name for user in crud.get_users()]
         self.assertFalse(self.are_there_dupes(a_list=login_names))
 
+    def test_password_rehash(self):
+        """Changing the bcrypt cost upgrades a user's hash the next time they log in."""
+
+        configured_rounds = password_hasher.rounds
+        try:
+            password_hasher.rounds = 4
+            user = crud.check_then_create_user(login_name='Melon Taster Old Hash', password="pi")
+            self.assertEqual(4, rounds_of(user.hashed_password))
+
+            password_hasher.rounds = 5
+            self.assertFalse(crud.does_password_match(user=user, password_from_form="not pi"))
+            self.assertEqual(4, rounds_of(user.hashed_password))
+            self.assertTrue(crud.does_password_match(user=user, password_from_form="pi"))
+            self.assertEqual(5, rounds_of(user.hashed_password))
+            self.assertTrue(crud.does_password_match(user=user, password_from_form="pi"))
+
+            # A busy pool skips the upgrade, not the login:
+            password_hasher.rounds = 6
+            with unittest.mock.patch.object(password_hasher, 'hash', side_effect=PasswordServiceBusy):
+                self.assertTrue(crud.does_password_match(user=user, password_from_form="pi"))
+            self.assertEqual(5, rounds_of(user.hashed_password))
+        finally:
+            password_hasher.rounds = configured_rounds
+
+    def test_async_password_check(self):
+        """The async server awaits the same bcrypt, and talks to the same database."""
+
+        hashed_password = password_hasher.hash("melon")
+        self.assertTrue(asyncio.run(password_hasher.verify_async("melon", hashed_password)))
+        self.assertFalse(asyncio.run(password_hasher.verify_async("lemon", hashed_password)))
+        self.assertEqual("postgresql+asyncpg:///reservations",
+                         async_server.async_uri("postgresql:///reservations"))
+
+    def test_async_routes(self):
+        """The async server searches, books once however often it's asked, and lists the booking."""
+
+        # The async engine has its own connections, so what it reads and writes has to be committed:
+        with db.engine.begin() as connection:
+            user_id = connection.execute(insert(User).values(
+                login_name='Melon Taster Async', hashed_password=crud.hash_it("xxx"))).inserted_primary_key[0]
+        try:
+            asyncio.run(self.async_requests(user_id))
+        finally:
+            with db.engine.begin() as connection:
+                appointment_ids = connection.execute(select(Reservation.appointment_id).where(
+                    Reservation.user_id == user_id)).scalars().all()
+                if appointment_ids:
+                    connection.execute(crud.give_back_station_statement(*appointment_ids))
+                connection.execute(delete(Reservation).where(Reservation.user_id == user_id))
+                connection.execute(delete(User).where(User.user_id == user_id))
+                # Slot rows the booking wrote, like the ones only booked slots get:
+                connection.execute(delete(Appointment).where(Appointment.booked_count == 0))
+
+    async def async_requests(self, user_id):
+        """test_async_routes() against async_server's Quart test client."""
+
+        async_server.connect_to_async_db(db.engine.url.render_as_string(hide_password=False))
+        client = async_server.app.test_client()
+        async with client.session_transaction() as session:
+            session['user_id'] = user_id
+        tomorrow = crud.format_computer_date(self.tomorrow)
+        try:
+            search = await client.get('/select_appointment', query_string={
+                'pick-date': tomorrow, 'pick-time1': '00:00', 'pick-time2': '23:59'})
+            self.assertEqual(200, search.status_code)
+            slot_key = list(crud.list_free_appointments(tomorrow))[0]
+            self.assertIn(slot_key.encode(), await search.get_data())
+
+            booking = {'book_this_appointment': slot_key, 'idempotency_key': idempotency.new_key()}
+            first_try = await client.post('/record_appointment', form=booking)
+            retry = await client.post('/record_appointment', form=booking)
+            self.assertEqual(first_try.headers['Location'], retry.headers['Location'])
+
+            my_reservations = await client.get('/my_reservations')
+            self.assertEqual(200, my_reservations.status_code)
+            page = await my_reservations.get_data()
+            self.assertIn(b'You got it!', page)
+            self.assertEqual(1, page.count(b'cancelButton'))
+        finally:
+            await async_server.async_session.kw['bind'].dispose()
+
+    def test_rate_limiter(self):
+        """A burst is allowed, then one attempt per refill."""
+
+        now = [0.0]
+        limiter = RateLimiter({'login_name': (6, 3)}, clock=lambda: now[0])
+        self.assertEqual([True, True, True, False],
+                         [limiter.allow('login_name', 'Melon Taster 1') for _ in range(4)])
+        self.assertTrue(limiter.allow('login_name', 'Melon Taster 2'))
+
+        now[0] += 10  # 6 a minute is one token every 10 seconds.
+        self.assertTrue(limiter.allow('login_name', 'Melon Taster 1'))
+        self.assertFalse(limiter.allow('login_name', 'Melon Taster 1'))
+
+        # Login is turned away before the password is checked:
+        for _ in range(10):
+            response = self.client.post('/login', data={
+                'login_name': 'Melon Taster 1', 'password': 'not a secret'})
+        self.assertEqual('0', response.headers['X-SQL-Queries'])
+
+        # Behind one proxy, the client is the address it appended; a spoofed entry is ignored:
+        self.assertEqual('10.0.0.7', client_address('10.0.0.1', '6.6.6.6, 10.0.0.7', trusted_proxies=1))
+        self.assertEqual('10.0.0.1', client_address('10.0.0.1', '6.6.6.6', trusted_proxies=0))
+
     def test_reservations(self):
         """Tests for reservation crud"""
 
@@ -86,6 +277,386 @@ class TestReservationsDB(unittest.TestCase):
         reservation_appointment_ids = [res.appointment_id for res in crud.get_reservations()]
         self.assertFalse(self.are_there_dupes(a_list=reservation_appointment_ids))
 
+        # The database turns away a taken slot and a second booking on the same day:
+        taken_appointment = crud.get_reservations()[0].appointment
+        new_user = crud.check_then_create_user(login_name='Melon Taster Late', password="xxx")
+        self.assertFalse(crud.can_user_book_this_reservation(
+            user=new_user, desired_appointment=taken_appointment))
+
+        free_slots = crud.search_for_available_appointments(
+            new_user, desired_day=crud.format_computer_date(self.tomorrow))
+        first_free, same_day_free = [
+            crud.get_or_create_appointment(crud.parse_slot_key(slot_key))
+            for slot_key in list(free_slots)[:2]]
+        self.assertTrue(crud.can_user_book_this_reservation(
+            user=new_user, desired_appointment=first_free))
+        self.assertFalse(crud.can_user_book_this_reservation(
+            user=new_user, desired_appointment=same_day_free))
+
+        # The day check sees the new booking, and only on its own day:
+        self.assertTrue(crud.does_user_already_have_a_reservation_this_day(
+            new_user, crud.format_computer_date(self.tomorrow)))
+        self.assertFalse(crud.does_user_already_have_a_reservation_this_day(
+            new_user, crud.format_computer_date(self.tomorrow + timedelta(days=1))))
+
+    def test_slot_capacity(self):
+        """With two stations a slot takes two people, stays searchable until full, and reopens on cancel."""
+
+        schedule_rules.schedule_rule = schedule_rules.ScheduleRule(
+            slot_minutes=60, horizon_days=3, stations=2)
+        first, second, third = [
+            crud.check_then_create_user(login_name=f'Melon Taster Station {n}', password="xxx")
+            for n in range(3)]
+        appointment = self.first_free_appointment(first)
+        slot_key = crud.format_slot_key(appointment.appointment_date_time)
+        self.assertEqual(2, appointment.capacity)
+
+        self.assertTrue(crud.can_user_book_this_reservation(first, appointment))
+        self.assertIn(slot_key, self.free_slot_keys(second))
+        second_reservation = crud.can_user_book_this_reservation(second, appointment)
+        self.assertTrue(second_reservation)
+        self.assertNotIn(slot_key, self.free_slot_keys(third))
+        self.assertFalse(crud.can_user_book_this_reservation(third, appointment))
+        self.assertEqual(2, crud.get_appointment_by_id(appointment.appointment_id).booked_count)
+
+        # A day conflict doesn't use up a station:
+        same_day = crud.get_or_create_appointment(crud.parse_slot_key(self.free_slot_keys(third)[1]))
+        self.assertFalse(crud.can_user_book_this_reservation(first, same_day))
+        self.assertEqual(0, crud.get_appointment_by_id(same_day.appointment_id).booked_count)
+
+        crud.delete_reservation(second_reservation)
+        self.assertEqual(1, crud.get_appointment_by_id(appointment.appointment_id).booked_count)
+        self.assertIn(slot_key, self.free_slot_keys(third))
+
+    def test_slot_events(self):
+        """Booking and cancelling tell everyone who's listening."""
+
+        subscriber = events.slot_events.subscribe()
+        try:
+            new_user = crud.check_then_create_user(login_name='Melon Taster Live', password="xxx")
+            appointment = self.first_free_appointment(new_user)
+            slot_key = crud.format_slot_key(appointment.appointment_date_time)
+            reservation_id = crud.can_user_book_this_reservation(new_user, appointment)
+            crud.delete_reservation(reservation_id)
+
+            event_type, data = subscriber.get_nowait()
+            self.assertEqual(('slot-taken', slot_key), (event_type, data['slot']))
+            event_type, data = subscriber.get_nowait()
+            self.assertEqual(('slot-freed', slot_key), (event_type, data['slot']))
+        finally:
+            events.slot_events.unsubscribe(subscriber)
+
+        # Streams end on their own; the page's EventSource reconnects after the retry delay:
+        self.assertEqual([f"retry: {events.RECONNECT_MILLISECONDS}\n\n"],
+                         list(events.stream_slot_events(stream_seconds=0)))
+
+    def test_idempotent_booking(self):
+        """A retried booking gets the first answer back without touching the database."""
+
+        new_user = self.login_new_user('Melon Taster Retry')
+        slot_key = self.free_slot_keys(new_user)[0]
+        booking = {'book_this_appointment': slot_key, 'idempotency_key': idempotency.new_key()}
+
+        first_try = self.client.post('/record_appointment', data=booking)
+        retry = self.client.post('/record_appointment', data=booking)
+        self.assertEqual(first_try.location, retry.location)
+        self.assertEqual(0, int(retry.headers['X-SQL-Queries']))
+        self.assertIn(b'You got it!', self.client.get('/my_reservations').data)
+        self.assertEqual(1, len(crud.get_my_reservations(new_user)))
+
+        # A worker that never saw the first try finds the booking it made:
+        idempotency.idempotent_outcomes.clear()
+        self.client.post('/record_appointment', data=booking)
+        self.assertIn(b'You got it!', self.client.get('/my_reservations').data)
+
+        # The first try claims its key before it starts; nothing else can claim or overwrite it:
+        key = (new_user.user_id, '/record_appointment', (), idempotency.new_key())
+        pending, _ = idempotency.try_claim(key)
+        self.assertEqual((None, pending), idempotency.try_claim(key))
+        self.assertTrue(idempotency.idempotent_outcomes.replace(key, pending, "first"))
+        self.assertFalse(idempotency.idempotent_outcomes.replace(key, pending, "second"))
+        self.assertEqual("first", idempotency.idempotent_outcomes.get(key))
+
+    def test_batch_booking(self):
+        """One POST books a slot per day and says what happened to each one."""
+
+        new_user = self.login_new_user('Melon Taster Batch')
+        day_after = self.tomorrow + timedelta(days=1)
+        tomorrow_slots = self.free_slot_keys(new_user)
+        day_after_slots = self.free_slot_keys(new_user, day_after)
+        taken_slot = self.first_free_appointment(new_user, day_after)
+        other_user = crud.check_then_create_user(login_name='Melon Taster Early Bird', password="xxx")
+        crud.can_user_book_this_reservation(user=other_user, desired_appointment=taken_slot)
+
+        response = self.client.post('/record_appointments', data={'book_this_appointment': [
+            tomorrow_slots[0], tomorrow_slots[1], day_after_slots[0], 'not a slot']})
+        self.assertEqual(['booked', 'same day', 'full', 'not bookable'],
+                         [result['outcome'] for result in response.json['results']])
+        booked_id = response.json['results'][0]['reservation_id']
+        self.assertEqual(tomorrow_slots[0], crud.format_slot_key(
+            crud.get_reservation_by_id(booked_id).appointment.appointment_date_time))
+        self.assertNotIn(tomorrow_slots[0], crud.list_free_appointments(
+            crud.format_computer_date(self.tomorrow)) or {})
+
+        # The day already taken counts against the next batch:
+        response = self.client.post('/record_appointments', data={'book_this_appointment': [
+            tomorrow_slots[2], day_after_slots[1]]})
+        self.assertEqual(['same day', 'booked'],
+                         [result['outcome'] for result in response.json['results']])
+
+    def test_waitlist(self):
+        """A cancellation books the slot for the earliest waiter who can take it."""
+
+        tomorrow = crud.format_computer_date(self.tomorrow)
+        free_slots = [crud.parse_slot_key(slot_key) for slot_key in crud.list_free_appointments(tomorrow)]
+        slot, later_slot = free_slots[0], free_slots[-1]
+        window = (crud.format_slot_key(slot)[11:], crud.format_slot_key(slot + timedelta(hours=1))[11:])
+        holder = crud.check_then_create_user(login_name='Melon Taster Holder', password="xxx")
+        reservation_id = crud.can_user_book_this_reservation(
+            user=holder, desired_appointment=crud.get_or_create_appointment(slot))
+
+        # First in line, but books another slot that day before anything opens up:
+        busy_waiter = crud.check_then_create_user(login_name='Melon Taster Busy', password="xxx")
+        self.assertTrue(crud.join_waitlist(busy_waiter, tomorrow, *window))
+        self.assertTrue(crud.can_user_book_this_reservation(
+            user=busy_waiter, desired_appointment=crud.get_or_create_appointment(later_slot)))
+        self.assertFalse(crud.join_waitlist(busy_waiter, tomorrow, *window))
+
+        waiter = crud.check_then_create_user(login_name='Melon Taster Waiting', password="xxx")
+        yesterday = crud.format_computer_date(date.today() - timedelta(days=1))
+        self.assertIsNone(crud.join_waitlist(waiter, yesterday, *window))
+        self.assertTrue(crud.join_waitlist(waiter, tomorrow, *window))
+
+        crud.delete_reservation(reservation_id)
+        self.assertEqual([(tomorrow, crud.get_appointment_by_date_time(slot).reservations[0].reservation_id)],
+                         crud.get_my_reservations(waiter, human_readable=False))
+        self.assertEqual([], waiter.waitlist_entries)
+        self.assertEqual([], busy_waiter.waitlist_entries)  # Used up by their own booking.
+        self.assertNotIn(crud.format_slot_key(slot), crud.list_free_appointments(tomorrow) or {})
+
+        # A day they've booked offers neither the waitlist nor slots that open up:
+        with self.client.session_transaction() as session:
+            session['user_id'] = busy_waiter.user_id
+        page = self.client.get('/select_appointment', query_string={
+            'pick-date': tomorrow, 'pick-time1': window[0], 'pick-time2': window[1]}).data
+        self.assertIn(b'id="day-taken"', page)
+        self.assertNotIn(b'/join_waitlist', page)
+        self.assertNotIn(b'EventSource', page)
+
+    def test_page_etags(self):
+        """An unchanged page is a 304 without a query; booking changes its ETag."""
+
+        new_user = self.login_new_user('Melon Taster ETag')
+
+        etag = self.client.get('/my_reservations').headers['ETag']
+        revisit = self.client.get('/my_reservations', headers={'If-None-Match': etag})
+        self.assertEqual(304, revisit.status_code)
+        self.assertEqual(0, int(revisit.headers['X-SQL-Queries']))
+
+        self.client.post('/record_appointment', data={'book_this_appointment': self.free_slot_keys(new_user)[0]})
+        self.client.get('/my_reservations')  # Shows the flash message.
+        after_booking = self.client.get('/my_reservations', headers={'If-None-Match': etag})
+        self.assertEqual(200, after_booking.status_code)
+        self.assertNotEqual(etag, after_booking.headers['ETag'])
+
+        # A search page's ETag follows the day's full slots, not the clock:
+        day_after = self.tomorrow + timedelta(days=1)
+        search = {'pick-date': crud.format_computer_date(day_after), 'pick-time1': '00:00', 'pick-time2': '23:59'}
+        etag = self.client.get('/select_appointment', query_string=search).headers['ETag']
+        later = time.time() + versions.PAGE_MAX_AGE
+        with unittest.mock.patch('versions.time.time', return_value=later):
+            revisit = self.client.get('/select_appointment', query_string=search, headers={'If-None-Match': etag})
+        self.assertEqual(304, revisit.status_code)
+        other_user = crud.check_then_create_user(login_name='Melon Taster ETag Rival', password="xxx")
+        crud.can_user_book_this_reservation(other_user, self.first_free_appointment(other_user, day_after))
+        revisit = self.client.get('/select_appointment', query_string=search, headers={'If-None-Match': etag})
+        self.assertEqual(200, revisit.status_code)
+
+    def test_my_reservations_pages(self):
+        """Following the cursors visits every upcoming reservation once, in order."""
+
+        user = crud.get_user_by_login_name(login_name='Melon Taster 1')
+        all_reservations = crud.get_my_reservations(user=user)
+
+        pages_seen = []
+        next_cursor = None
+        while True:
+            page, next_cursor = crud.get_my_reservations_page(
+                user=user, cursor=next_cursor, page_size=1)
+            pages_seen.extend(page)
+            if next_cursor is None:
+                break
+        self.assertEqual(all_reservations, pages_seen)
+
+        # Nothing has happened yet, so there are no past tastings:
+        self.assertEqual(([], None), crud.get_my_reservations_page(user=user, upcoming=False))
+
+    def test_archive_past_slots(self):
+        """Old slots move to the archive, and past pages read on into it."""
+
+        user = crud.get_user_by_login_name(login_name='Melon Taster 1')
+        days_ago = [maintenance.ARCHIVE_AFTER_DAYS + 10, maintenance.ARCHIVE_AFTER_DAYS + 5, 2]
+        for days in days_ago:
+            slot = datetime.combine(date.today() - timedelta(days=days), datetime.min.time())
+            appointment = Appointment(appointment_date_time=slot, booked_count=1)
+            db.session.add(Reservation(user=user, appointment=appointment, reservation_date=slot.date()))
+        db.session.commit()
+
+        self.assertEqual((2, 2), maintenance.archive_past_slots())
+        self.assertEqual((0, 0), maintenance.archive_past_slots())
+        self.assertEqual(2, ArchivedReservation.query.filter_by(user_id=user.user_id).count())
+        self.assertFalse(Appointment.query.filter(
+            Appointment.appointment_date_time < maintenance.archive_cutoff()).count())
+
+        past_reservations = []
+        next_cursor = None
+        while True:
+            page, next_cursor = crud.get_my_reservations_page(
+                user=user, upcoming=False, cursor=next_cursor, page_size=1)
+            past_reservations.extend(page)
+            if next_cursor is None:
+                break
+        self.assertEqual(
+            [crud.format_human_datetime(datetime.combine(
+                date.today() - timedelta(days=days), datetime.min.time())) for days in sorted(days_ago)],
+            [human_date_time for human_date_time, _ in past_reservations])
+
+    def test_delete_past_waits(self):
+        """Maintenance deletes waitlist entries once their day has gone by."""
+
+        user = crud.get_user_by_login_name(login_name='Melon Taster 1')
+        for day in [date.today() - timedelta(days=2), date.today() - timedelta(days=1), date.today()]:
+            db.session.add(WaitlistEntry(user=user, wait_date=day, start_time=datetime.min.time(),
+                                         end_time=datetime.max.time().replace(microsecond=0)))
+        db.session.commit()
+
+        self.assertEqual(2, maintenance.delete_past_waits())
+        self.assertEqual(0, maintenance.delete_past_waits())
+        self.assertEqual([date.today()], [entry.wait_date for entry in WaitlistEntry.query.filter_by(
+            user_id=user.user_id)])
+
+    def test_availability_index(self):
+        """Search results come from the in-process index and follow bookings."""
+
+        new_user = crud.check_then_create_user(login_name='Melon Taster Index', password="xxx")
+
+        # Index agrees with the database:
+        available = self.free_slot_keys(new_user)
+        booked_slots = {res.appointment.appointment_date_time for res in crud.get_reservations()}
+        expected_slots = [
+            crud.format_slot_key(slot) for slot in schedule_rules.schedule_rule.slots_on(self.tomorrow)
+            if slot not in booked_slots]
+        self.assertEqual(expected_slots, available)
+
+        # Booking removes the slot; cancelling puts it back:
+        slot_key = available[0]
+        appointment = self.first_free_appointment(new_user)
+        reservation_id = crud.can_user_book_this_reservation(new_user, appointment)
+        other_user = crud.check_then_create_user(login_name='Melon Taster Other', password="xxx")
+        self.assertNotIn(slot_key, self.free_slot_keys(other_user))
+        crud.delete_reservation(reservation_id)
+        self.assertIn(slot_key, self.free_slot_keys(other_user))
+
+        # Another worker fills the slot; this index catches up once it's max_age old:
+        db.session.execute(update(Appointment).where(
+            Appointment.appointment_id == appointment.appointment_id).values(booked_count=Appointment.capacity))
+        db.session.commit()
+        self.assertIn(slot_key, self.free_slot_keys(other_user))
+        availability_index.loaded_at -= availability_index.max_age
+        self.assertNotIn(slot_key, self.free_slot_keys(other_user))
+
+    def test_availability_calendar(self):
+        """One call covers every day, matches the per-day search and skips booked days."""
+
+        user = crud.get_user_by_login_name(login_name='Melon Taster 1')
+        my_days = {reservation_date for reservation_date, _ in crud.get_my_reservations(
+            user=user, human_readable=False)}
+        calendar = crud.get_availability_calendar(
+            user, date.today(), date.today() + timedelta(days=30), include_slots=True)
+
+        for day_number in range(4):
+            day = crud.format_computer_date(date.today() + timedelta(days=day_number))
+            if day in my_days:
+                self.assertNotIn(day, calendar)
+            else:
+                available = crud.search_for_available_appointments(user, desired_day=day) or {}
+                self.assertEqual(len(available), calendar[day]['free'])
+                self.assertEqual(available, calendar[day]['slots'])
+        # Nothing offered past the horizon:
+        self.assertEqual(4, len(calendar) + len(my_days))
+
+        self.assertEqual(401, self.client.get('/availability_calendar').status_code)
+        self.login_new_user('Melon Taster Calendar')
+        self.assertEqual(400, self.client.get('/availability_calendar?month=bad').status_code)
+        self.assertEqual(200, self.client.get('/availability_calendar').status_code)
+
+    def test_sql_instrumentation(self):
+        """Every response says how much SQL it took."""
+
+        with self.client.session_transaction() as session:
+            session['user_id'] = 1
+        response = self.client.get('/my_reservations')
+        self.assertEqual(200, response.status_code)
+        self.assertGreater(int(response.headers['X-SQL-Queries']), 0)
+        self.assertIn('/my_reservations', instrumentation.route_stats())
+        self.assertEqual(403, self.client.get('/metrics').status_code)  # Not an admin.
+
+        # A statement that fails doesn't leave its start time behind:
+        with db.engine.connect() as connection:
+            with self.assertRaises(exc.DBAPIError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            self.assertEqual([], connection.info['query_start_times'])
+
+        # Same statement, different literals, same fingerprint:
+        self.assertEqual(
+            instrumentation.fingerprint("SELECT * FROM users WHERE user_id IN (1, 2, 3)"),
+            instrumentation.fingerprint("SELECT *  FROM users WHERE user_id IN (%(a)s)"))
+
+    def test_replica_routing(self):
+        """Reads go to the replica until a session writes; after that it reads from the primary."""
+
+        replica_url = db.engine.url.set(database=f"{db.engine.url.database}_replica")
+        os.system(f"createdb {replica_url.database} 2> /dev/null")
+        use_replicas(app, [replica_url.render_as_string(hide_password=False)])
+        replica = db.get_engine(app, bind='replica_0')
+        try:
+            db.Model.metadata.create_all(bind=replica)  # Same schema, no users.
+            routed_session = db.create_scoped_session()
+            self.assertEqual(0, routed_session.query(User).count())
+            routed_session.execute(update(User).where(User.user_id == 0).values(login_name='nobody'))
+            self.assertEqual(3, routed_session.query(User).count())
+            routed_session.rollback()
+            routed_session.remove()
+        finally:
+            use_replicas(app, [])
+            db.Model.metadata.drop_all(bind=replica)
+            replica.dispose()
+            os.system(f"dropdb {replica_url.database} 2> /dev/null")
+
+    def test_current_user_cache(self):
+        """The logged-in user is loaded from the database once, not on every page."""
+
+        with self.client.session_transaction() as session:
+            session['user_id'] = 1
+        first_visit = self.client.get('/my_reservations')
+        second_visit = self.client.get('/my_reservations')
+        self.assertIn(b'Melon Taster 1', second_visit.data)
+        self.assertEqual(int(first_visit.headers['X-SQL-Queries']) - 1,
+                         int(second_visit.headers['X-SQL-Queries']))
+
+        # Logging out forgets the user:
+        self.client.get('/logout')
+        self.assertNotIn(1, current_user.identity_cache)
+
+    def test_export(self):
+        """The export has one line per reservation, plus the CSV header."""
+
+        number_of_reservations = len(crud.get_reservations())
+        csv_text = "".join(export.iter_export('csv'))
+        self.assertEqual(number_of_reservations + 1, len(csv_text.splitlines()))
+        jsonl_lines = "".join(export.iter_export('jsonl')).splitlines()
+        self.assertEqual(number_of_reservations, len(jsonl_lines))
+
     @staticmethod
     def are_there_dupes(a_list):
         """There are many columns where we can not allow collisions in data."""
@@ -95,12 +666,41 @@ class TestReservationsDB(unittest.TestCase):
         else:
             return True
 
+    def login_new_user(self, login_name):
+        """Create a user and log the test client in as them."""
+
+        user = crud.check_then_create_user(login_name=login_name, password="xxx")
+        with self.client.session_transaction() as session:
+            session['user_id'] = user.user_id
+        return user
+
+    def free_slot_keys(self, user, day=None):
+        """Slot keys the user's search finds free on day (tomorrow by default), in order."""
+
+        return list(crud.search_for_available_appointments(
+            user, desired_day=crud.format_computer_date(day or self.tomorrow)) or {})
+
+    def first_free_appointment(self, user, day=None):
+        """The Appointment for the first of free_slot_keys(), created if it has no row yet."""
+
+        return crud.get_or_create_appointment(crud.parse_slot_key(self.free_slot_keys(user, day)[0]))
+
     def tearDown(self):
         """This runs after every def test_* function."""
 
-        db.session.close()
+        db.session.remove()
         # Test Data is purged at the end of each test:
+        self.transaction.rollback()
+        self.connection.close()
+        db.session = self.session
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once, after every def test_* function."""
+
+        db.session.close()
         db.drop_all()
+        password_hasher.rounds, password_hasher.workers = cls.configured_rounds, cls.configured_workers
 
 
 if __name__ == "__main__":
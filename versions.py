@@ -0,0 +1,68 @@
+"""Page versions for Melon Tasting Reservations
+
+My Reservations and the search pages carry an ETag, so a browser revalidating
+an unchanged page (back button, refresh) gets a 304 before we run a query or
+render a template.
+
+An ETag is built only from things every server process agrees on: the page
+and its arguments, the user, and a stamp in the browser session that moves
+whenever that browser books or cancels. The search page adds that day's
+full slots from the availability index, so it changes as soon as the index
+does, and workers whose indexes agree hand out the same tag. Pages with
+nothing like that to go on (or a search while the index is stale) add the
+wall clock instead, which moves every PAGE_MAX_AGE seconds, so changes made
+anywhere else (a waitlist promotion, another device) reach a cached page
+within that long.
+"""
+
+import os
+import time
+from datetime import datetime
+from hashlib import sha1
+from uuid import uuid4
+
+from flask import has_request_context, session
+
+import schedule_rules
+from availability import AVAILABILITY_MAX_AGE
+
+PAGE_MAX_AGE = float(os.environ.get('PAGE_MAX_AGE', AVAILABILITY_MAX_AGE))  # seconds a 304 can be stale
+
+
+def reservations_changed(user_id, browser_session=None):
+    """Call when user_id books or cancels.
+
+    browser_session defaults to Flask's session; it's stamped if it belongs to user_id."""
+
+    if browser_session is None and has_request_context():
+        browser_session = session
+    if browser_session is not None and browser_session.get('user_id') == user_id:
+        browser_session['reservations_version'] = uuid4().hex
+
+
+def clock(now=None):
+    """Moves on at every slot start, when today's slots start and upcoming tastings become past ones."""
+
+    now = now or datetime.now()
+    minutes = now.hour * 60 + now.minute
+    return f"{now:%Y-%m-%d}/{minutes // schedule_rules.schedule_rule.slot_minutes}"
+
+
+def page_etag(browser_session, page, *arguments, availability=None):
+    """The ETag of page, as the browser_session's user sees it.
+
+    arguments are whatever else shapes the page (query string values).
+    availability is what the page shows of other people's bookings, e.g.
+    availability_index.full_slots_on(day); None falls back to the wall clock."""
+
+    if availability is None:
+        availability = int(time.time() // PAGE_MAX_AGE)
+    version = (clock(), availability, page, arguments,
+               browser_session.get('user_id'), browser_session.get('reservations_version'))
+    return sha1(repr(version).encode('utf8')).hexdigest()
+
+
+def is_fresh(browser_session, if_none_match, etag):
+    """True if the browser's cached copy (if_none_match) is etag and there are no flash messages waiting."""
+
+    return '_flashes' not in browser_session and if_none_match.contains(etag)